@@ -26,19 +26,68 @@ const Dashboard = ({ dadosBoletim, setDadosBoletim }) => {
     );
   }
 
+  const recalcularCompleto = async (novaMedia) => {
+    const response = await axios.post('http://localhost:5001/api/calculate', {
+      disciplinas: dadosBoletim.disciplinas,
+      mediaMinima: novaMedia
+    });
+
+    return { disciplinas: response.data.disciplinas, sessionId: undefined, etag: undefined };
+  };
+
+  const recalcularIncremental = async (novaMedia, disciplinasAtuais, etag) => {
+    // Modo incremental: envia só a nova média e recebe só as linhas alteradas
+    const response = await axios.post('http://localhost:5001/api/calculate', {
+      sessionId: dadosBoletim.sessionId,
+      mediaMinima: novaMedia
+    }, {
+      headers: etag ? { 'If-Match': etag } : {}
+    });
+
+    const disciplinas = disciplinasAtuais.map(d => ({
+      ...d,
+      media_minima: response.data.mediaMinima
+    }));
+    response.data.alteracoes.forEach(({ index, ...campos }) => {
+      disciplinas[index] = { ...disciplinas[index], ...campos };
+    });
+
+    return { disciplinas, sessionId: dadosBoletim.sessionId, etag: response.headers.etag };
+  };
+
+  const recalcular = async (novaMedia) => {
+    if (!dadosBoletim.sessionId) {
+      return recalcularCompleto(novaMedia);
+    }
+
+    try {
+      return await recalcularIncremental(novaMedia, dadosBoletim.disciplinas, dadosBoletim.etag);
+    } catch (error) {
+      const status = error.response?.status;
+      if (status === 404) {
+        // Sessão expirou (CALC_SESSION_TTL) ou o servidor reiniciou: volta ao envio completo
+        return recalcularCompleto(novaMedia);
+      }
+      if (status === 412) {
+        // Cópia local desatualizada: ressincroniza o estado da sessão e tenta de novo
+        const estado = await axios.get(`http://localhost:5001/api/calculate/${dadosBoletim.sessionId}`);
+        return recalcularIncremental(novaMedia, estado.data.disciplinas, estado.headers.etag);
+      }
+      throw error;
+    }
+  };
+
   const handleMediaChange = async (novaMedia) => {
     setMediaMinima(novaMedia);
     setLoading(true);
 
     try {
-      const response = await axios.post('http://localhost:5001/api/calculate', {
-        disciplinas: dadosBoletim.disciplinas,
-        mediaMinima: novaMedia
-      });
-
+      const { disciplinas, sessionId, etag } = await recalcular(novaMedia);
       setDadosBoletim({
         ...dadosBoletim,
-        disciplinas: response.data.disciplinas
+        disciplinas,
+        sessionId,
+        etag
       });
     } catch (error) {
       console.error('Erro ao recalcular:', error);
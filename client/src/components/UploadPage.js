@@ -74,7 +74,11 @@ const UploadPage = ({ setDadosBoletim }) => {
       console.log('Resposta recebida:', response.data);
       
       if (response.data.success && response.data.dados) {
-        setDadosBoletim(response.data.dados);
+        setDadosBoletim({
+          ...response.data.dados,
+          sessionId: response.data.sessionId,
+          etag: response.headers.etag
+        });
         navigate('/dashboard');
       } else {
         setError('Resposta inválida do servidor');
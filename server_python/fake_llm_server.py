@@ -0,0 +1,292 @@
+"""
+Servidor LLM falso (compatível com Ollama e OpenAI) para testes de carga offline.
+
+Responde com JSON de boletim realista, com latência configurável, streaming,
+truncamento e injeção de erros. Uso:
+
+    python fake_llm_server.py --port 11434 --latency-ms 800 --truncate-rate 0.05
+
+Depois aponte o servidor principal para ele:
+
+    OLLAMA_BASE_URL=http://localhost:11434 LLM_PROVIDER=ollama python main.py
+    # ou
+    OPENAI_API_BASE=http://localhost:11434/v1 OPENAI_API_KEY=sk-fake python main.py
+"""
+import argparse
+import asyncio
+import hashlib
+import json
+import math
+import random
+import time
+from datetime import datetime, timezone
+
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+app = FastAPI(title="Fake LLM (Ollama/OpenAI)")
+
+# Configuração (sobrescrita pelos argumentos de linha de comando)
+CONFIG = {
+    "latency_ms": 500.0,
+    "latency_jitter_ms": 200.0,
+    "latency_dist": "lognormal",
+    "stream_chunk_ms": 10.0,
+    "truncate_rate": 0.0,
+    "error_rate": 0.0,
+    "disciplinas": 15,
+}
+
+DISCIPLINAS = [
+    "EMPREENDEDORISMO", "FILOSOFIA", "GEOGRAFIA", "HISTÓRIA", "SOCIOLOGIA",
+    "BIOLOGIA I", "BIOLOGIA II", "FÍSICA I", "FÍSICA II", "QUÍMICA", "REDAÇÃO",
+    "ÉTICA E CIDADANIA", "CIÊNCIAS", "EDUCAÇÃO FÍSICA", "ENSINO DA ARTE",
+    "ESPANHOL", "INGLÊS", "LITERATURA", "ANÁLISE LINGUÍSTICA", "PRODUÇÃO DE TEXTO",
+    "MATEMÁTICA", "PROJETO DE VIDA", "UNIDADE CURRICULAR DE HUMANAS",
+    "UNIDADE CURRICULAR DE NATUREZA", "TRAJETÓRIA DE LEITURA E ESCRITA",
+]
+
+# Marcadores que separam as instruções do texto do boletim nos prompts do main.py
+MARCADORES_TEXTO = ("Texto extraído do boletim:", "Trecho do boletim:", "Texto do cabeçalho do boletim:")
+
+STATS = {"requisicoes": 0, "erros_injetados": 0, "truncadas": 0}
+
+
+def sample_latency() -> float:
+    """Latência em segundos conforme a distribuição configurada"""
+    media = CONFIG["latency_ms"]
+    desvio = CONFIG["latency_jitter_ms"]
+    dist = CONFIG["latency_dist"]
+    if dist == "fixed":
+        valor = media
+    elif dist == "uniform":
+        valor = random.uniform(media - desvio, media + desvio)
+    elif dist == "normal":
+        valor = random.gauss(media, desvio)
+    else:
+        # Lognormal com a média e o desvio pedidos (cauda longa, como LLMs reais)
+        if media <= 0:
+            valor = 0
+        else:
+            sigma = math.sqrt(math.log1p((desvio / media) ** 2))
+            mu = math.log(media) - sigma ** 2 / 2
+            valor = random.lognormvariate(mu, sigma)
+    return max(0.0, valor) / 1000
+
+
+def build_boletim(prompt: str) -> str:
+    """Gera a resposta JSON conforme o tipo de prompt recebido"""
+    if prompt.strip().lower() == "test":
+        return "ok"
+    
+    texto = prompt
+    for marcador in MARCADORES_TEXTO:
+        if marcador in prompt:
+            texto = prompt.rsplit(marcador, 1)[1]
+            break
+    
+    # Mesma entrada gera a mesma resposta (facilita comparar execuções)
+    rng = random.Random(hashlib.md5(prompt.encode()).hexdigest())
+    
+    cabecalho = {
+        "aluno": "ALUNO TESTE DA SILVA",
+        "matricula": str(rng.randint(100000, 999999)),
+        "turma": f"{rng.randint(6, 9)}{rng.choice('ABC')}",
+        "ano": 2024,
+        "bimestre": f"{rng.randint(1, 4)}º Bimestre",
+    }
+    if "dados de identificação" in prompt:
+        return json.dumps(cabecalho, ensure_ascii=False)
+    
+    linhas = {linha.strip().upper() for linha in texto.splitlines()} if texto is not prompt else set()
+    encontradas = [d for d in DISCIPLINAS if d in linhas]
+    nomes = encontradas or DISCIPLINAS[:CONFIG["disciplinas"]]
+    
+    disciplinas = []
+    for nome in nomes:
+        notas = [round(rng.uniform(4, 10), 1) for _ in range(3)]
+        if rng.random() < 0.3:
+            notas[2] = None
+        validas = [n for n in notas if n is not None]
+        media = round(sum(validas) / len(validas), 2)
+        disciplinas.append({
+            "nome": nome,
+            "faltas": rng.randint(0, 6),
+            "notas": notas,
+            "pontos_extras": 0,
+            "media_provisoria": media,
+            "media_parcial": media,
+        })
+    
+    if "TRECHO" in prompt:
+        return json.dumps({"disciplinas": disciplinas}, ensure_ascii=False)
+    return json.dumps({**cabecalho, "disciplinas": disciplinas}, ensure_ascii=False)
+
+
+def maybe_truncate(texto: str) -> str:
+    """Corta a resposta no meio (simula JSON truncado por limite de tokens/timeout)"""
+    if len(texto) > 20 and random.random() < CONFIG["truncate_rate"]:
+        STATS["truncadas"] += 1
+        return texto[:random.randint(len(texto) // 3, len(texto) - 5)]
+    return texto
+
+
+async def generate(prompt: str):
+    """Aplica latência, erro e truncamento. Retorna (texto, resposta de erro ou None)"""
+    STATS["requisicoes"] += 1
+    await asyncio.sleep(sample_latency())
+    if random.random() < CONFIG["error_rate"]:
+        STATS["erros_injetados"] += 1
+        return None, JSONResponse({"error": "erro injetado pelo fake_llm_server"}, status_code=500)
+    return maybe_truncate(build_boletim(prompt)), None
+
+
+def chunks(texto: str, tamanho: int = 12):
+    for i in range(0, len(texto), tamanho):
+        yield texto[i:i + tamanho]
+
+
+def messages_to_prompt(messages: list) -> str:
+    partes = []
+    for mensagem in messages or []:
+        conteudo = mensagem.get("content", "")
+        if isinstance(conteudo, list):
+            conteudo = "".join(p.get("text", "") for p in conteudo if isinstance(p, dict))
+        partes.append(conteudo)
+    return "\n".join(partes)
+
+
+def now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+# ---------------------------------------------------------------- Ollama
+
+@app.get("/api/tags")
+async def ollama_tags():
+    return {"models": [{"name": "llama3.2:latest", "model": "llama3.2:latest"}]}
+
+
+@app.post("/api/generate")
+async def ollama_generate(request: Request):
+    body = await request.json()
+    texto, erro = await generate(body.get("prompt", ""))
+    if erro:
+        return erro
+    modelo = body.get("model", "llama3.2")
+    
+    if body.get("stream", True):
+        async def stream():
+            for parte in chunks(texto):
+                yield json.dumps({"model": modelo, "created_at": now_iso(), "response": parte, "done": False}) + "\n"
+                await asyncio.sleep(CONFIG["stream_chunk_ms"] / 1000)
+            yield json.dumps({"model": modelo, "created_at": now_iso(), "response": "", "done": True, "done_reason": "stop"}) + "\n"
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+    
+    return {"model": modelo, "created_at": now_iso(), "response": texto, "done": True, "done_reason": "stop"}
+
+
+@app.post("/api/chat")
+async def ollama_chat(request: Request):
+    body = await request.json()
+    texto, erro = await generate(messages_to_prompt(body.get("messages")))
+    if erro:
+        return erro
+    modelo = body.get("model", "llama3.2")
+    
+    if body.get("stream", True):
+        async def stream():
+            for parte in chunks(texto):
+                yield json.dumps({"model": modelo, "created_at": now_iso(), "message": {"role": "assistant", "content": parte}, "done": False}) + "\n"
+                await asyncio.sleep(CONFIG["stream_chunk_ms"] / 1000)
+            yield json.dumps({"model": modelo, "created_at": now_iso(), "message": {"role": "assistant", "content": ""}, "done": True, "done_reason": "stop"}) + "\n"
+        return StreamingResponse(stream(), media_type="application/x-ndjson")
+    
+    return {"model": modelo, "created_at": now_iso(), "message": {"role": "assistant", "content": texto}, "done": True, "done_reason": "stop"}
+
+
+# ---------------------------------------------------------------- OpenAI
+
+@app.post("/v1/chat/completions")
+async def openai_chat(request: Request):
+    body = await request.json()
+    texto, erro = await generate(messages_to_prompt(body.get("messages")))
+    if erro:
+        return erro
+    modelo = body.get("model", "gpt-4o-mini")
+    resposta_id = f"chatcmpl-{random.getrandbits(48):x}"
+    criado = int(time.time())
+    
+    if body.get("stream"):
+        async def stream():
+            for parte in chunks(texto):
+                evento = {"id": resposta_id, "object": "chat.completion.chunk", "created": criado, "model": modelo,
+                          "choices": [{"index": 0, "delta": {"role": "assistant", "content": parte}, "finish_reason": None}]}
+                yield f"data: {json.dumps(evento)}\n\n"
+                await asyncio.sleep(CONFIG["stream_chunk_ms"] / 1000)
+            evento = {"id": resposta_id, "object": "chat.completion.chunk", "created": criado, "model": modelo,
+                      "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}]}
+            yield f"data: {json.dumps(evento)}\n\ndata: [DONE]\n\n"
+        return StreamingResponse(stream(), media_type="text/event-stream")
+    
+    return {
+        "id": resposta_id,
+        "object": "chat.completion",
+        "created": criado,
+        "model": modelo,
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": texto}, "finish_reason": "stop"}],
+        "usage": {"prompt_tokens": len(str(body.get("messages"))) // 4, "completion_tokens": len(texto) // 4, "total_tokens": 0},
+    }
+
+
+@app.post("/v1/embeddings")
+async def openai_embeddings(request: Request):
+    """Embeddings determinísticos (necessários para o VectorStoreIndex no modo OpenAI)"""
+    body = await request.json()
+    entradas = body.get("input", [])
+    if isinstance(entradas, str):
+        entradas = [entradas]
+    dados = []
+    for i, entrada in enumerate(entradas):
+        rng = random.Random(hashlib.md5(str(entrada).encode()).hexdigest())
+        dados.append({"object": "embedding", "index": i, "embedding": [rng.uniform(-1, 1) for _ in range(1536)]})
+    return {"object": "list", "data": dados, "model": body.get("model", "text-embedding-ada-002"),
+            "usage": {"prompt_tokens": 0, "total_tokens": 0}}
+
+
+@app.get("/stats")
+async def stats():
+    """Contadores do servidor falso (requisições, erros injetados, truncamentos)"""
+    return STATS
+
+
+if __name__ == "__main__":
+    import uvicorn
+    
+    parser = argparse.ArgumentParser(description="Servidor LLM falso (Ollama/OpenAI) para testes de carga")
+    parser.add_argument("--port", type=int, default=11434)
+    parser.add_argument("--latency-ms", type=float, default=CONFIG["latency_ms"], help="Latência média por requisição")
+    parser.add_argument("--latency-jitter-ms", type=float, default=CONFIG["latency_jitter_ms"], help="Desvio da latência")
+    parser.add_argument("--latency-dist", choices=["fixed", "uniform", "normal", "lognormal"], default=CONFIG["latency_dist"])
+    parser.add_argument("--stream-chunk-ms", type=float, default=CONFIG["stream_chunk_ms"], help="Intervalo entre chunks no streaming")
+    parser.add_argument("--truncate-rate", type=float, default=CONFIG["truncate_rate"], help="Fração de respostas com JSON truncado (0-1)")
+    parser.add_argument("--error-rate", type=float, default=CONFIG["error_rate"], help="Fração de respostas HTTP 500 (0-1)")
+    parser.add_argument("--disciplinas", type=int, default=CONFIG["disciplinas"], help="Disciplinas por boletim quando o prompt não traz o texto")
+    parser.add_argument("--seed", type=int, default=None, help="Semente para latência/erros reproduzíveis")
+    args = parser.parse_args()
+    
+    CONFIG.update({
+        "latency_ms": args.latency_ms,
+        "latency_jitter_ms": args.latency_jitter_ms,
+        "latency_dist": args.latency_dist,
+        "stream_chunk_ms": args.stream_chunk_ms,
+        "truncate_rate": args.truncate_rate,
+        "error_rate": args.error_rate,
+        "disciplinas": args.disciplinas,
+    })
+    if args.seed is not None:
+        random.seed(args.seed)
+    
+    print(f"🧪 Fake LLM em http://localhost:{args.port} ({args.latency_dist}, {args.latency_ms}ms ± {args.latency_jitter_ms}ms, "
+          f"truncamento {args.truncate_rate:.0%}, erros {args.error_rate:.0%})")
+    uvicorn.run(app, host="0.0.0.0", port=args.port, log_level="warning")
@@ -0,0 +1,122 @@
+"""
+Gerador de carga para /api/upload.
+
+Envia a mesma imagem (ou as imagens de um diretório, em rodízio) com uma
+concorrência alvo e reporta vazão, percentis de latência e taxa de erros.
+Combine com fake_llm_server.py para medir capacidade sem Ollama/OpenAI reais:
+
+    python fake_llm_server.py --latency-ms 800 &
+    OLLAMA_BASE_URL=http://localhost:11434 LLM_PROVIDER=ollama python main.py &
+    python load_test.py boletim.jpg --concurrency 8 --requests 200
+"""
+import argparse
+import asyncio
+import json
+import mimetypes
+import time
+from collections import Counter
+from pathlib import Path
+
+import httpx
+
+IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+
+
+def percentile(valores: list, p: float) -> float:
+    """Percentil por interpolação linear (valores já ordenados)"""
+    if not valores:
+        return 0.0
+    k = (len(valores) - 1) * p / 100
+    inferior = int(k)
+    superior = min(inferior + 1, len(valores) - 1)
+    return valores[inferior] + (valores[superior] - valores[inferior]) * (k - inferior)
+
+
+async def run_load(url: str, imagens: list, concorrencia: int, total: int, duracao: float, timeout: float) -> dict:
+    arquivos = [(p.name, p.read_bytes(), mimetypes.guess_type(p.name)[0] or "image/jpeg") for p in imagens]
+    latencias = []
+    status = Counter()
+    enviadas = 0
+    inicio = time.perf_counter()
+    
+    def proxima():
+        """Índice da próxima requisição ou None quando o limite foi atingido"""
+        nonlocal enviadas
+        if total and enviadas >= total:
+            return None
+        if duracao and time.perf_counter() - inicio >= duracao:
+            return None
+        enviadas += 1
+        return enviadas - 1
+    
+    async def worker(client):
+        while (n := proxima()) is not None:
+            nome, conteudo, tipo = arquivos[n % len(arquivos)]
+            t0 = time.perf_counter()
+            try:
+                resposta = await client.post(url, files={"boletim": (nome, conteudo, tipo)})
+                chave = resposta.status_code
+            except httpx.TimeoutException:
+                chave = "timeout"
+            except httpx.HTTPError as e:
+                chave = type(e).__name__
+            latencias.append(time.perf_counter() - t0)
+            status[chave] += 1
+    
+    limites = httpx.Limits(max_connections=concorrencia, max_keepalive_connections=concorrencia)
+    async with httpx.AsyncClient(timeout=timeout, limits=limites) as client:
+        await asyncio.gather(*(worker(client) for _ in range(concorrencia)))
+    
+    tempo_total = time.perf_counter() - inicio
+    latencias.sort()
+    sucesso = status.get(200, 0)
+    quantidade = len(latencias)
+    return {
+        "requisicoes": quantidade,
+        "concorrencia": concorrencia,
+        "segundos": round(tempo_total, 2),
+        "vazao_rps": round(quantidade / tempo_total, 3) if tempo_total else 0,
+        "boletins_por_minuto": round(sucesso / tempo_total * 60, 1) if tempo_total else 0,
+        "taxa_erro": round(1 - sucesso / quantidade, 4) if quantidade else 0,
+        "status": {str(k): v for k, v in status.items()},
+        "latencia_s": {
+            "min": round(latencias[0], 3) if latencias else 0,
+            "p50": round(percentile(latencias, 50), 3),
+            "p90": round(percentile(latencias, 90), 3),
+            "p95": round(percentile(latencias, 95), 3),
+            "p99": round(percentile(latencias, 99), 3),
+            "max": round(latencias[-1], 3) if latencias else 0,
+        },
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Teste de carga para /api/upload")
+    parser.add_argument("imagem", help="Imagem de boletim ou diretório com imagens")
+    parser.add_argument("--url", default="http://localhost:5001/api/upload")
+    parser.add_argument("-c", "--concurrency", type=int, default=4, help="Requisições simultâneas")
+    parser.add_argument("-n", "--requests", type=int, default=50, help="Total de requisições (0 = sem limite, usar --duration)")
+    parser.add_argument("-d", "--duration", type=float, default=0, help="Duração máxima em segundos (0 = sem limite)")
+    parser.add_argument("--timeout", type=float, default=300, help="Timeout por requisição (segundos)")
+    parser.add_argument("--json", action="store_true", help="Imprime apenas o resultado em JSON")
+    args = parser.parse_args()
+    
+    caminho = Path(args.imagem)
+    imagens = sorted(p for p in caminho.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS) if caminho.is_dir() else [caminho]
+    if not imagens:
+        parser.error(f"Nenhuma imagem encontrada em {caminho}")
+    if not args.requests and not args.duration:
+        parser.error("Informe --requests ou --duration")
+    
+    if not args.json:
+        print(f"🚀 {args.url} | concorrência {args.concurrency} | {len(imagens)} imagem(ns)")
+    resultado = asyncio.run(run_load(args.url, imagens, args.concurrency, args.requests, args.duration, args.timeout))
+    
+    if args.json:
+        print(json.dumps(resultado, ensure_ascii=False))
+    else:
+        lat = resultado["latencia_s"]
+        print(f"\n📊 {resultado['requisicoes']} requisições em {resultado['segundos']}s")
+        print(f"   Vazão: {resultado['vazao_rps']} req/s ({resultado['boletins_por_minuto']} boletins/min)")
+        print(f"   Latência: p50 {lat['p50']}s | p90 {lat['p90']}s | p95 {lat['p95']}s | p99 {lat['p99']}s | max {lat['max']}s")
+        print(f"   Erros: {resultado['taxa_erro']:.1%} | status: {resultado['status']}")
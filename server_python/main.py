@@ -1,9 +1,10 @@
 """
 Servidor FastAPI com LlamaIndex + OCR para processamento de boletins escolares
 """
-from fastapi import FastAPI, File, UploadFile, HTTPException
+from fastapi import FastAPI, File, UploadFile, HTTPException, Request
+from fastapi.concurrency import run_in_threadpool
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, Response
 from llama_index.core import SimpleDirectoryReader, VectorStoreIndex, Settings, Document
 from llama_index.readers.file import ImageReader
 from llama_index.llms.openai import OpenAI
@@ -14,8 +15,17 @@ import tempfile
 import time
 from pathlib import Path
 from typing import Optional
+import gc
 import json
+import multiprocessing as mp
+import re
+import sys
+import threading
+import tracemalloc
 import unicodedata
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing.connection import wait as wait_connections
 from dotenv import load_dotenv
 
 # OCR imports
@@ -25,6 +35,12 @@ try:
 except ImportError:
     PADDLEOCR_AVAILABLE = False
 
+try:
+    from PIL import Image, ImageOps
+    PIL_AVAILABLE = True
+except ImportError:
+    PIL_AVAILABLE = False
+
 try:
     import pytesseract
     from PIL import Image
@@ -32,6 +48,17 @@ try:
 except ImportError:
     TESSERACT_AVAILABLE = False
 
+try:
+    import numpy as np
+    NUMPY_AVAILABLE = True
+except ImportError:
+    NUMPY_AVAILABLE = False
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
 load_dotenv()
 
 app = FastAPI(title="Sistema de Análise de Boletim Escolar")
@@ -43,6 +70,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["ETag"],
 )
 
 # Configurações
@@ -66,7 +94,14 @@ if LLM_PROVIDER == "openai":
 if LLM_PROVIDER == "ollama":
     try:
         # Timeout aumentado para 300 segundos (5 minutos) para processar textos grandes
-        Settings.llm = Ollama(model="llama3.2", request_timeout=300.0)
+        # OLLAMA_BASE_URL permite apontar para outro host (ex: fake_llm_server.py em testes de carga)
+        Settings.llm = Ollama(
+            model="llama3.2",
+            base_url=os.getenv("OLLAMA_BASE_URL", "http://localhost:11434"),
+            request_timeout=300.0,
+            # Manter o modelo carregado entre requisições para reaproveitar o prefixo do prompt
+            keep_alive=os.getenv("OLLAMA_KEEP_ALIVE", "30m"),
+        )
         # Ollama não precisa de embeddings separados, usa os do modelo
         print("✅ Usando Ollama (llama3.2)")
         print("💡 Certifique-se de que o Ollama está rodando: ollama serve")
@@ -83,10 +118,17 @@ print(f"✅ OCR Engine: {OCR_ENGINE}")
 
 # Inicializar PaddleOCR de forma lazy (só quando necessário)
 _paddleocr_instance = None
+_paddleocr_last_used = 0.0
+# PaddleOCR não é thread-safe: chamadas e descarregamento passam por este lock
+_paddleocr_lock = threading.RLock()
+
+# Descarregar o PaddleOCR após N segundos sem uso (0 = nunca)
+OCR_IDLE_UNLOAD_SECONDS = float(os.getenv("OCR_IDLE_UNLOAD_SECONDS", 0))
+_ocr_reaper_started = False
 
 def get_paddleocr_instance():
     """Inicializa PaddleOCR de forma lazy"""
-    global _paddleocr_instance
+    global _paddleocr_instance, _paddleocr_last_used
     if _paddleocr_instance is None:
         try:
             print("🔄 Inicializando PaddleOCR (pode demorar na primeira vez)...")
@@ -95,9 +137,461 @@ def get_paddleocr_instance():
         except Exception as e:
             print(f"❌ Erro ao inicializar PaddleOCR: {e}")
             raise
+        start_ocr_reaper()
+    _paddleocr_last_used = time.time()
     return _paddleocr_instance
 
 
+def _ocr_reaper():
+    """Thread que descarrega o PaddleOCR quando fica ocioso"""
+    global _paddleocr_instance
+    intervalo = max(1.0, OCR_IDLE_UNLOAD_SECONDS / 4)
+    while True:
+        time.sleep(intervalo)
+        if _paddleocr_instance is None or time.time() - _paddleocr_last_used < OCR_IDLE_UNLOAD_SECONDS:
+            continue
+        with _paddleocr_lock:
+            # Conferir de novo: pode ter sido usado enquanto esperava o lock
+            if _paddleocr_instance is not None and time.time() - _paddleocr_last_used >= OCR_IDLE_UNLOAD_SECONDS:
+                _paddleocr_instance = None
+                gc.collect()
+                print(f"🧹 PaddleOCR descarregado após {OCR_IDLE_UNLOAD_SECONDS:.0f}s ocioso (RSS: {current_rss_mb():.0f} MB)")
+
+
+def start_ocr_reaper():
+    global _ocr_reaper_started
+    if OCR_IDLE_UNLOAD_SECONDS > 0 and not _ocr_reaper_started:
+        _ocr_reaper_started = True
+        threading.Thread(target=_ocr_reaper, daemon=True, name="ocr-reaper").start()
+
+
+# Controle de memória
+# Limite de pixels decodificados por imagem (maiores são reduzidas antes do OCR)
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", 12_000_000))
+# Orçamento de memória do processo em MB (0 = sem controle de admissão)
+MEMORY_BUDGET_MB = float(os.getenv("MEMORY_BUDGET_MB", 0))
+# Estimativa inicial de memória por megapixel processado (ajustada pelas medições)
+OCR_MB_PER_MEGAPIXEL = float(os.getenv("OCR_MB_PER_MEGAPIXEL", 40))
+# Rastrear alocações Python com tracemalloc (tem custo de CPU)
+MEMORY_TRACEMALLOC = os.getenv("MEMORY_TRACEMALLOC", "false").lower() in ("1", "true", "yes")
+
+if MEMORY_TRACEMALLOC:
+    tracemalloc.start()
+
+
+def current_rss_mb() -> float:
+    """Memória residente (RSS) atual do processo em MB"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 2**20
+    except (OSError, ValueError, AttributeError):
+        pass
+    if resource is None:
+        return 0.0
+    # Fora do Linux só há o pico (ru_maxrss): KB no Linux, bytes no macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == "darwin" else maxrss / 1024
+
+
+class MemoryTracker:
+    """
+    Mede o pico de memória de uma etapa: amostra o RSS em uma thread e,
+    se MEMORY_TRACEMALLOC estiver ativo, o pico de alocações Python.
+    Com requisições simultâneas os valores incluem o uso das outras.
+    O pico do tracemalloc é global: só o tracker mais externo ativo o zera e
+    o reporta (etapas aninhadas e requisições simultâneas ficam sem ele).
+    """
+
+    _ativos_python = 0
+    _ativos_lock = threading.Lock()
+
+    def __init__(self, etapa: str, intervalo: float = 0.05):
+        self.etapa = etapa
+        self.intervalo = intervalo
+        self.rss_inicial = 0.0
+        self.rss_pico = 0.0
+        self.python_pico_mb = None
+        self._mede_python = False
+        self._parar = threading.Event()
+
+    def _amostrar(self):
+        while not self._parar.wait(self.intervalo):
+            self.rss_pico = max(self.rss_pico, current_rss_mb())
+
+    def __enter__(self):
+        self.rss_inicial = self.rss_pico = current_rss_mb()
+        if MEMORY_TRACEMALLOC:
+            with MemoryTracker._ativos_lock:
+                self._mede_python = MemoryTracker._ativos_python == 0
+                MemoryTracker._ativos_python += 1
+                if self._mede_python:
+                    self._python_inicial = tracemalloc.get_traced_memory()[0]
+                    tracemalloc.reset_peak()
+        self._thread = threading.Thread(target=self._amostrar, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self._parar.set()
+        self._thread.join()
+        self.rss_pico = max(self.rss_pico, current_rss_mb())
+        if MEMORY_TRACEMALLOC:
+            with MemoryTracker._ativos_lock:
+                MemoryTracker._ativos_python -= 1
+                if self._mede_python:
+                    self.python_pico_mb = (tracemalloc.get_traced_memory()[1] - self._python_inicial) / 2**20
+        extra = f", Python +{self.python_pico_mb:.1f} MB" if self.python_pico_mb is not None else ""
+        print(f"🧠 Memória [{self.etapa}]: pico RSS {self.rss_pico:.0f} MB (+{self.aumento_mb:.0f} MB){extra}")
+        return False
+
+    @property
+    def aumento_mb(self) -> float:
+        return max(0.0, self.rss_pico - self.rss_inicial)
+
+
+class MemoryAdmission:
+    """
+    Controle de admissão por memória: uma requisição só começa quando
+    RSS base + memória reservada pelas em andamento + sua estimativa cabem
+    no orçamento. Caso contrário espera na fila. Uma requisição sempre é
+    admitida quando não há nenhuma em andamento, para não travar.
+
+    O RSS base é medido sem nenhuma requisição em andamento: o RSS atual já
+    inclui o uso das em andamento, e somar as estimativas a ele contaria essa
+    memória duas vezes (e o RSS raramente diminui depois de um pico). As
+    estimativas são corrigidas pelas medições em release().
+    """
+
+    def __init__(self, budget_mb: float, mb_por_megapixel: float):
+        self.budget_mb = budget_mb
+        self.mb_por_megapixel = mb_por_megapixel
+        self.reservado_mb = 0.0
+        self.rss_base_mb = 0.0
+        self.em_andamento = 0
+        self.na_fila = 0
+        self._cond = threading.Condition()
+
+    def estimate_mb(self, megapixels: float) -> float:
+        return max(1.0, megapixels * self.mb_por_megapixel)
+
+    def acquire(self, estimativa_mb: float):
+        if self.budget_mb <= 0:
+            return
+        with self._cond:
+            self.na_fila += 1
+            try:
+                while self.em_andamento > 0 and self.rss_base_mb + self.reservado_mb + estimativa_mb > self.budget_mb:
+                    self._cond.wait(timeout=1.0)
+            finally:
+                self.na_fila -= 1
+            if self.em_andamento == 0:
+                self.rss_base_mb = current_rss_mb()
+            self.reservado_mb += estimativa_mb
+            self.em_andamento += 1
+
+    def release(self, estimativa_mb: float, megapixels: float = 0, aumento_mb: float = 0):
+        if self.budget_mb <= 0:
+            return
+        with self._cond:
+            self.reservado_mb = max(0.0, self.reservado_mb - estimativa_mb)
+            self.em_andamento -= 1
+            # Ajustar a estimativa por megapixel com a medição real (média móvel)
+            if megapixels > 0 and aumento_mb > 0:
+                self.mb_por_megapixel = 0.8 * self.mb_por_megapixel + 0.2 * (aumento_mb / megapixels)
+            self._cond.notify_all()
+
+
+MEMORY_ADMISSION = MemoryAdmission(MEMORY_BUDGET_MB, OCR_MB_PER_MEGAPIXEL)
+
+
+def image_megapixels(image_path: str) -> float:
+    """Megapixels da imagem lendo só o cabeçalho (sem decodificar)"""
+    if not PIL_AVAILABLE:
+        return 0.0
+    try:
+        with Image.open(image_path) as image:
+            largura, altura = image.size
+        return largura * altura / 1_000_000
+    except Exception:
+        return 0.0
+
+
+def limit_image_pixels(image_path: str) -> str:
+    """
+    Reduz a imagem se passar de MAX_IMAGE_PIXELS. Retorna o caminho da
+    imagem a usar no OCR (o original ou uma cópia reduzida).
+    A cópia vai para o diretório temporário do sistema, nunca para o
+    diretório da imagem original (no lote, o acervo pode ser somente leitura).
+    """
+    if not PIL_AVAILABLE or MAX_IMAGE_PIXELS <= 0:
+        return image_path
+    try:
+        image = Image.open(image_path)
+    except Exception as e:
+        print(f"⚠️  Não foi possível verificar o tamanho da imagem: {e}")
+        return image_path
+    
+    caminho_reduzido = None
+    try:
+        with image:
+            largura, altura = image.size
+            if largura * altura <= MAX_IMAGE_PIXELS:
+                return image_path
+            escala = (MAX_IMAGE_PIXELS / (largura * altura)) ** 0.5
+            tamanho = (max(1, int(largura * escala)), max(1, int(altura * escala)))
+            # JPEG: draft decodifica direto em escala reduzida, sem alocar a imagem inteira
+            image.draft("RGB", tamanho)
+            # O PNG gerado não leva o EXIF: aplica a orientação antes de reduzir
+            reduzida = ImageOps.exif_transpose(image).convert("RGB")
+            if (reduzida.width > reduzida.height) != (largura > altura):
+                tamanho = (tamanho[1], tamanho[0])
+            reduzida.thumbnail(tamanho, Image.LANCZOS)
+            descritor, caminho_reduzido = tempfile.mkstemp(prefix="ocr-", suffix="-reduzida.png")
+            with os.fdopen(descritor, "wb") as arquivo:
+                reduzida.save(arquivo, format="PNG")
+    except Exception as e:
+        if caminho_reduzido and os.path.exists(caminho_reduzido):
+            os.remove(caminho_reduzido)
+        # Sem a redução o OCR decodificaria a imagem inteira, justamente o que o limite evita
+        raise HTTPException(status_code=500, detail=f"Erro ao reduzir imagem de {largura}x{altura}: {str(e)}")
+    
+    print(f"📐 Imagem reduzida de {largura}x{altura} para {reduzida.width}x{reduzida.height} (limite: {MAX_IMAGE_PIXELS} pixels)")
+    return caminho_reduzido
+
+
+# Disciplinas conhecidas (mesma lista usada no prompt de extração)
+# Formato: (nome canônico, observação exibida no prompt)
+DISCIPLINAS_CONHECIDAS = [
+    ("EMPREENDEDORISMO", None),
+    ("FILOSOFIA", None),
+    ("GEOGRAFIA", None),
+    ("HISTÓRIA", None),
+    ("SOCIOLOGIA", None),
+    ("BIOLOGIA", "pode ter subtabelas: Biologia I, Biologia II"),
+    ("FÍSICA", "pode ter subtabelas: Física I, Física II"),
+    ("QUÍMICA", None),
+    ("REDAÇÃO", None),
+    ("ÉTICA E CIDADANIA", None),
+    ("CIÊNCIAS", None),
+    ("EDUCAÇÃO FÍSICA", None),
+    ("ENSINO DA ARTE", None),
+    ("ESPANHOL", None),
+    ("INGLÊS", None),
+    ("LÍNGUA PORTUGUESA", "pode ter subtabelas: Literatura, Análise Linguística, Produção de Texto"),
+    ("MATEMÁTICA", None),
+    ("PROJETO DE VIDA", None),
+    ("UNIDADE CURRICULAR DE HUMANAS", None),
+    ("UNIDADE CURRICULAR DE NATUREZA", None),
+    ("TRAJETÓRIA DE LEITURA E ESCRITA", None),
+]
+
+# Subtabelas também são disciplinas válidas (tratadas separadamente)
+SUBDISCIPLINAS_CONHECIDAS = [
+    "BIOLOGIA I",
+    "BIOLOGIA II",
+    "FÍSICA I",
+    "FÍSICA II",
+    "LITERATURA",
+    "ANÁLISE LINGUÍSTICA",
+    "PRODUÇÃO DE TEXTO",
+]
+
+# Disciplinas customizadas, separadas por vírgula (ex: "ROBÓTICA,XADREZ")
+DISCIPLINAS_EXTRAS = [d.strip() for d in os.getenv("DISCIPLINAS_EXTRAS", "").split(",") if d.strip()]
+
+
+def normalize_string(s: str) -> str:
+    """Normaliza string para comparação (lowercase, sem acentos, sem espaços extras)"""
+    # Remove acentos
+    s = unicodedata.normalize('NFD', s)
+    s = ''.join(c for c in s if unicodedata.category(c) != 'Mn')
+    # Lowercase e colapsa espaços
+    return " ".join(s.lower().split())
+
+
+def levenshtein(a: str, b: str) -> int:
+    """Distância de edição entre duas strings"""
+    if len(a) < len(b):
+        a, b = b, a
+    anterior = list(range(len(b) + 1))
+    for i, ca in enumerate(a, 1):
+        atual = [i]
+        for j, cb in enumerate(b, 1):
+            atual.append(min(
+                anterior[j] + 1,
+                atual[j - 1] + 1,
+                anterior[j - 1] + (ca != cb),
+            ))
+        anterior = atual
+    return anterior[-1]
+
+
+# Sufixos de subtabela (I, II, III...) e confusões comuns do OCR neles
+_SUFIXOS_ROMANOS = {"i": "i", "ii": "ii", "iii": "iii", "iv": "iv",
+                    "1": "i", "2": "ii", "3": "iii", "4": "iv"}
+# Caracteres que o OCR troca pelo "I" romano ("FISICA Il", "BIOLOGIA l|")
+_CONFUSOES_I = str.maketrans({"l": "i", "1": "i", "|": "i", "!": "i"})
+
+
+def roman_suffix(palavra: str) -> Optional[str]:
+    """Sufixo romano normalizado ("i", "ii", "iii", "iv") ou None"""
+    if palavra in _SUFIXOS_ROMANOS:
+        return _SUFIXOS_ROMANOS[palavra]
+    if palavra.isdigit():
+        return None  # "11" é nota/falta, não "II"
+    return _SUFIXOS_ROMANOS.get(palavra.translate(_CONFUSOES_I))
+
+
+class DisciplinaIndex:
+    """
+    Índice pré-computado de disciplinas conhecidas para canonizar nomes
+    vindos do OCR/LLM ("MATEMATlCA" -> "MATEMÁTICA").
+
+    As chaves normalizadas vão para um dicionário (lookup exato) e para uma
+    BK-tree por sufixo de subtabela, para busca aproximada por distância de
+    edição sem confundir "FÍSICA I" com "FÍSICA II".
+    """
+
+    def __init__(self, nomes):
+        self._exato = {}
+        self._arvores = {}  # sufixo -> raiz da BK-tree (chave, canônico, filhos)
+        self._cache = {}
+        self._max_palavras = 1
+        for nome in nomes:
+            self.add(nome)
+
+    @staticmethod
+    def _split_key(nome: str):
+        """Separa a chave normalizada em (base, sufixo romano)"""
+        partes = normalize_string(nome).split()
+        sufixo = roman_suffix(partes[-1]) if len(partes) > 1 else None
+        if sufixo:
+            return " ".join(partes[:-1]), sufixo
+        return " ".join(partes), ""
+
+    @staticmethod
+    def _tolerancia(base: str) -> int:
+        """Distância máxima aceita, proporcional ao tamanho do nome"""
+        if len(base) < 5:
+            return 0
+        return min(3, max(1, len(base) // 6))
+
+    def add(self, nome: str):
+        base, sufixo = self._split_key(nome)
+        if not base:
+            return
+        chave = f"{base} {sufixo}".strip()
+        if chave in self._exato:
+            return
+        self._exato[chave] = nome
+        self._cache.clear()
+        self._max_palavras = max(self._max_palavras, len(chave.split()))
+
+        no = self._arvores.get(sufixo)
+        if no is None:
+            self._arvores[sufixo] = (base, nome, {})
+            return
+        while True:
+            d = levenshtein(base, no[0])
+            if d == 0:
+                return
+            filho = no[2].get(d)
+            if filho is None:
+                no[2][d] = (base, nome, {})
+                return
+            no = filho
+
+    def _buscar(self, base: str, sufixo: str, tolerancia: int):
+        raiz = self._arvores.get(sufixo)
+        if raiz is None:
+            return None
+        melhor = None
+        pendentes = [raiz]
+        while pendentes:
+            no = pendentes.pop()
+            d = levenshtein(base, no[0])
+            if d <= tolerancia and (melhor is None or d < melhor[0]):
+                melhor = (d, no[1])
+            for dist_filho, filho in no[2].items():
+                if d - tolerancia <= dist_filho <= d + tolerancia:
+                    pendentes.append(filho)
+        return melhor[1] if melhor else None
+
+    def canonical(self, nome: str) -> Optional[str]:
+        """Retorna o nome canônico da disciplina ou None se não for conhecida"""
+        if nome in self._cache:
+            return self._cache[nome]
+
+        base, sufixo = self._split_key(nome)
+        resultado = self._exato.get(f"{base} {sufixo}".strip())
+        if resultado is None and base:
+            resultado = self._buscar(base, sufixo, self._tolerancia(base))
+
+        if len(self._cache) >= 4096:
+            self._cache.clear()
+        self._cache[nome] = resultado
+        return resultado
+
+    def match_line(self, linha: str) -> Optional[str]:
+        """
+        Reconhece a disciplina no início de uma linha de OCR. O Tesseract devolve
+        a linha inteira da tabela ("MATEMÁTICA 8,0 7,5 0"), então testa os prefixos
+        de palavras (do mais longo ao mais curto) até o primeiro número.
+        """
+        palavras = []
+        for palavra in linha.split():
+            if any(c.isdigit() for c in palavra) and not roman_suffix(normalize_string(palavra)):
+                break
+            palavras.append(palavra)
+            if len(palavras) > self._max_palavras:
+                break
+        for tamanho in range(min(len(palavras), self._max_palavras + 1), 0, -1):
+            canonico = self.canonical(" ".join(palavras[:tamanho]))
+            if canonico:
+                return canonico
+        return None
+
+    def key(self, nome: str) -> str:
+        """Chave de deduplicação: canônico se conhecido, senão o nome normalizado"""
+        return normalize_string(self.canonical(nome) or nome)
+
+
+# Lista de disciplinas no formato do prompt de extração
+DISCIPLINAS_PROMPT = "\n".join(
+    f"- {nome} ({obs})" if obs else f"- {nome}" for nome, obs in DISCIPLINAS_CONHECIDAS
+)
+
+DISCIPLINA_INDEX = DisciplinaIndex(
+    [nome for nome, _ in DISCIPLINAS_CONHECIDAS] + SUBDISCIPLINAS_CONHECIDAS + DISCIPLINAS_EXTRAS
+)
+print(f"✅ Índice de disciplinas: {len(DISCIPLINA_INDEX._exato)} nomes conhecidos")
+
+
+def merge_disciplinas(principal: dict, secundaria: dict) -> dict:
+    """
+    Mescla duas leituras da mesma disciplina: mantém a que tem mais notas e
+    preenche as posições vazias com os valores da outra
+    """
+    notas_principal = [n for n in principal["notas"] if n is not None]
+    notas_secundaria = [n for n in secundaria["notas"] if n is not None]
+    if len(notas_secundaria) > len(notas_principal):
+        principal, secundaria = secundaria, principal
+
+    mesclada = dict(principal)
+    mesclada["notas"] = [
+        n if n is not None else m
+        for n, m in zip(principal["notas"], secundaria["notas"])
+    ]
+    mesclada["faltas"] = max(principal["faltas"], secundaria["faltas"])
+    mesclada["pontos_extras"] = principal["pontos_extras"] or secundaria["pontos_extras"]
+    for campo in ("media_provisoria", "media_parcial"):
+        if campo not in mesclada and campo in secundaria:
+            mesclada[campo] = secundaria[campo]
+    if "ocr_confianca" in secundaria:
+        mesclada["ocr_confianca"] = min(mesclada.get("ocr_confianca", 1.0), secundaria["ocr_confianca"])
+    return mesclada
+
+
 def validate_and_sanitize_data(data: dict) -> dict:
     """
     Valida e sanitiza os dados extraídos do boletim
@@ -122,29 +616,9 @@ def validate_and_sanitize_data(data: dict) -> dict:
         if not nome:
             continue
         
-        # Normalizar nome para comparação (lowercase, sem acentos, sem espaços extras)
-        def normalize_string(s):
-            # Remove acentos
-            s = unicodedata.normalize('NFD', s)
-            s = ''.join(c for c in s if unicodedata.category(c) != 'Mn')
-            # Lowercase e remove espaços extras
-            return s.lower().strip()
-        
-        nome_normalizado = normalize_string(nome)
-        
-        # Verificar duplicatas (mesma disciplina em maiúsculas/minúsculas)
-        if nome_normalizado in disciplinas_nomes:
-            # Se já existe, manter a que tem mais dados válidos
-            disciplina_existente = disciplinas_nomes[nome_normalizado]
-            notas_nova = [n for n in disciplina.get("notas", []) if n is not None]
-            notas_existente = [n for n in disciplina_existente.get("notas", []) if n is not None]
-            
-            if len(notas_nova) > len(notas_existente):
-                # Nova disciplina tem mais notas, substituir
-                disciplinas_validas.remove(disciplina_existente)
-            else:
-                # Manter a existente, pular esta
-                continue
+        # Mapear para o nome canônico (corrige erros de OCR como "MATEMATlCA")
+        nome = DISCIPLINA_INDEX.canonical(nome) or nome
+        nome_normalizado = DISCIPLINA_INDEX.key(nome)
         
         # Validar e sanitizar faltas
         faltas = disciplina.get("faltas")
@@ -247,7 +721,18 @@ def validate_and_sanitize_data(data: dict) -> dict:
         if media_parcial is not None:
             disciplina_sanitizada["media_parcial"] = media_parcial
         
-        disciplinas_validas.append(disciplina_sanitizada)
+        # Confiança do OCR na linha da disciplina (0-1)
+        ocr_confianca = disciplina.get("ocr_confianca")
+        if isinstance(ocr_confianca, (int, float)) and 0 <= ocr_confianca <= 1:
+            disciplina_sanitizada["ocr_confianca"] = ocr_confianca
+        
+        # Verificar duplicatas (mesma disciplina com grafia/OCR diferente)
+        if nome_normalizado in disciplinas_nomes:
+            disciplina_existente = disciplinas_nomes[nome_normalizado]
+            disciplina_sanitizada = merge_disciplinas(disciplina_existente, disciplina_sanitizada)
+            disciplinas_validas[disciplinas_validas.index(disciplina_existente)] = disciplina_sanitizada
+        else:
+            disciplinas_validas.append(disciplina_sanitizada)
         disciplinas_nomes[nome_normalizado] = disciplina_sanitizada
     
     # Atualizar dados com disciplinas validadas
@@ -308,9 +793,42 @@ def calculate_averages(disciplina: dict, media_minima: float = 7.0) -> dict:
     }
 
 
-def extract_text_with_ocr(image_path: str) -> str:
+# Confiança do OCR e reprocessamento seletivo
+# Linhas abaixo do limiar são recortadas, ampliadas e lidas de novo (mesmo engine e o outro)
+OCR_CONFIDENCE_THRESHOLD = float(os.getenv("OCR_CONFIDENCE_THRESHOLD", 0.8))
+OCR_REOCR_SCALE = float(os.getenv("OCR_REOCR_SCALE", 2.0))
+OCR_REOCR_MAX_LINES = int(os.getenv("OCR_REOCR_MAX_LINES", 30))  # 0 = não reprocessar
+# Folga acima do limiar exigida de uma leitura do outro engine que discorde nos números
+OCR_REOCR_CROSS_MARGIN = float(os.getenv("OCR_REOCR_CROSS_MARGIN", 0.1))
+
+
+def extract_lines_with_ocr(image_path: str) -> list:
     """
-    Extrai texto da imagem usando OCR (PaddleOCR ou Tesseract)
+    Extrai as linhas da imagem com OCR (PaddleOCR ou Tesseract), com a
+    confiança e a caixa de cada linha. Imagens acima de MAX_IMAGE_PIXELS são
+    reduzidas e linhas com baixa confiança são reprocessadas.
+    """
+    caminho_ocr = limit_image_pixels(image_path)
+    try:
+        with MemoryTracker("ocr"):
+            if OCR_ENGINE == "paddleocr":
+                with _paddleocr_lock:
+                    linhas = run_ocr_engine(caminho_ocr)
+                    return reocr_low_confidence(caminho_ocr, linhas)
+            linhas = run_ocr_engine(caminho_ocr)
+            return reocr_low_confidence(caminho_ocr, linhas)
+    finally:
+        if caminho_ocr != image_path and os.path.exists(caminho_ocr):
+            os.remove(caminho_ocr)
+
+
+def ocr_lines_to_text(linhas: list) -> str:
+    return "\n".join(linha["texto"] for linha in linhas)
+
+
+def run_ocr_engine(image_path: str) -> list:
+    """
+    Executa o engine de OCR configurado (PaddleOCR ou Tesseract)
     """
     print(f"🔍 Iniciando OCR com {OCR_ENGINE}...")
     
@@ -327,7 +845,7 @@ def extract_text_with_ocr(image_path: str) -> str:
                 # Se Tesseract estiver disponível, usar como fallback
                 if TESSERACT_AVAILABLE:
                     print("🔄 Fallback automático para Tesseract...")
-                    return extract_text_with_tesseract(image_path)
+                    return extract_lines_with_tesseract(image_path)
                 else:
                     raise HTTPException(
                         status_code=500, 
@@ -336,16 +854,23 @@ def extract_text_with_ocr(image_path: str) -> str:
             
             result = ocr.ocr(image_path, cls=True)
             
-            # Extrair texto de todos os resultados
-            text_lines = []
+            # Extrair texto, confiança e caixa de todos os resultados
+            linhas = []
             if result and result[0]:
                 for line in result[0]:
                     if line and len(line) >= 2:
-                        text_lines.append(line[1][0])  # line[1][0] é o texto reconhecido
+                        # line[0] são os 4 cantos da caixa, line[1] é (texto, confiança)
+                        xs = [p[0] for p in line[0]]
+                        ys = [p[1] for p in line[0]]
+                        linhas.append({
+                            "texto": line[1][0],
+                            "confianca": float(line[1][1]),
+                            "caixa": (min(xs), min(ys), max(xs), max(ys)),
+                            "engine": "paddleocr",
+                        })
             
-            text = "\n".join(text_lines)
-            print(f"✅ OCR concluído. Texto extraído: {len(text)} caracteres")
-            return text
+            print(f"✅ OCR concluído. Texto extraído: {len(ocr_lines_to_text(linhas))} caracteres em {len(linhas)} linhas")
+            return linhas
         except HTTPException:
             raise
         except Exception as e:
@@ -354,7 +879,7 @@ def extract_text_with_ocr(image_path: str) -> str:
             if TESSERACT_AVAILABLE:
                 print("🔄 Fallback automático para Tesseract devido a erro no PaddleOCR...")
                 try:
-                    return extract_text_with_tesseract(image_path)
+                    return extract_lines_with_tesseract(image_path)
                 except Exception as e2:
                     raise HTTPException(
                         status_code=500, 
@@ -367,14 +892,51 @@ def extract_text_with_ocr(image_path: str) -> str:
                 )
     
     elif OCR_ENGINE == "tesseract":
-        return extract_text_with_tesseract(image_path)
+        return extract_lines_with_tesseract(image_path)
     else:
         raise HTTPException(status_code=500, detail=f"OCR engine '{OCR_ENGINE}' não suportado. Use 'paddleocr' ou 'tesseract'")
 
 
-def extract_text_with_tesseract(image_path: str) -> str:
+def _tesseract_lines(image, config: str = "") -> list:
     """
-    Extrai texto usando Tesseract OCR
+    Roda o Tesseract e agrupa as palavras em linhas (confiança média da linha, 0-1)
+    """
+    # Tentar português primeiro, se falhar usar inglês
+    try:
+        dados = pytesseract.image_to_data(image, lang='por', config=config, output_type=pytesseract.Output.DICT)
+    except Exception as e:
+        print(f"⚠️  Erro ao usar Tesseract com 'por': {e}")
+        print("🔄 Tentando com 'eng' (inglês)...")
+        dados = pytesseract.image_to_data(image, lang='eng', config=config, output_type=pytesseract.Output.DICT)
+    
+    grupos = {}
+    for i, palavra in enumerate(dados["text"]):
+        confianca = float(dados["conf"][i])
+        if not palavra.strip() or confianca < 0:
+            continue
+        chave = (dados["block_num"][i], dados["par_num"][i], dados["line_num"][i])
+        x0, y0 = dados["left"][i], dados["top"][i]
+        x1, y1 = x0 + dados["width"][i], y0 + dados["height"][i]
+        grupo = grupos.setdefault(chave, {"palavras": [], "confiancas": [], "caixa": [x0, y0, x1, y1]})
+        grupo["palavras"].append(palavra.strip())
+        grupo["confiancas"].append(confianca)
+        caixa = grupo["caixa"]
+        grupo["caixa"] = [min(caixa[0], x0), min(caixa[1], y0), max(caixa[2], x1), max(caixa[3], y1)]
+    
+    return [
+        {
+            "texto": " ".join(grupo["palavras"]),
+            "confianca": round(sum(grupo["confiancas"]) / len(grupo["confiancas"]) / 100, 4),
+            "caixa": tuple(grupo["caixa"]),
+            "engine": "tesseract",
+        }
+        for grupo in grupos.values()
+    ]
+
+
+def extract_lines_with_tesseract(image_path: str) -> list:
+    """
+    Extrai linhas usando Tesseract OCR
     """
     if not TESSERACT_AVAILABLE:
         raise HTTPException(
@@ -383,30 +945,544 @@ def extract_text_with_tesseract(image_path: str) -> str:
         )
     
     try:
-        image = Image.open(image_path)
-        # Tentar português primeiro, se falhar usar inglês
-        try:
-            text = pytesseract.image_to_string(image, lang='por')
-        except Exception as e:
-            print(f"⚠️  Erro ao usar Tesseract com 'por': {e}")
-            print("🔄 Tentando com 'eng' (inglês)...")
-            text = pytesseract.image_to_string(image, lang='eng')
+        with Image.open(image_path) as image:
+            linhas = _tesseract_lines(image)
         
-        print(f"✅ OCR concluído. Texto extraído: {len(text)} caracteres")
-        return text
+        print(f"✅ OCR concluído. Texto extraído: {len(ocr_lines_to_text(linhas))} caracteres em {len(linhas)} linhas")
+        return linhas
     except Exception as e:
         print(f"❌ Erro no Tesseract: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro no OCR: {str(e)}")
 
 
-def extract_boletim_data_with_llamaindex(image_path: str) -> dict:
+def _reocr_candidates(recorte, engine_original: str):
     """
-    Extrai dados do boletim usando LlamaIndex + OCR
+    Relê um recorte ampliado de uma linha: primeiro com o mesmo engine,
+    depois com o outro. Gera (texto, confiança, engine).
     """
-    print(f"📄 Processando imagem: {image_path}")
+    engines = [engine_original] + [e for e in ("paddleocr", "tesseract") if e != engine_original]
+    for engine in engines:
+        try:
+            if engine == "paddleocr" and PADDLEOCR_AVAILABLE and NUMPY_AVAILABLE:
+                with _paddleocr_lock:
+                    # Só reconhecimento (det=False): a caixa já é conhecida. PaddleOCR espera BGR
+                    resultado = get_paddleocr_instance().ocr(np.array(recorte)[:, :, ::-1], det=False, cls=True)
+                if resultado and resultado[0]:
+                    texto, confianca = resultado[0][0]
+                    yield texto, float(confianca), engine
+            elif engine == "tesseract" and TESSERACT_AVAILABLE:
+                # psm 7: o recorte é uma única linha de texto
+                linhas = _tesseract_lines(recorte, config="--psm 7")
+                if linhas:
+                    yield " ".join(l["texto"] for l in linhas), min(l["confianca"] for l in linhas), engine
+        except Exception as e:
+            print(f"⚠️  Erro ao reprocessar linha com {engine}: {e}")
+
+
+def _numeric_tokens(texto: str) -> list:
+    """Números da linha (notas, faltas), com vírgula decimal normalizada"""
+    return [n.replace(",", ".") for n in re.findall(r"\d+(?:[.,]\d+)?", texto)]
+
+
+def _accept_reocr(atual: dict, texto: str, confianca: float, engine: str) -> bool:
+    """
+    Decide se a releitura substitui a leitura atual. Confianças do mesmo engine
+    são comparáveis; as do PaddleOCR e do Tesseract estão em escalas diferentes,
+    então a leitura do outro engine só vale se concordar nos números (e passar
+    do limiar) ou se passar do limiar com folga.
+    """
+    if not texto.strip():
+        return False
+    if engine == atual.get("engine", OCR_ENGINE):
+        return confianca > atual["confianca"]
+    if confianca >= OCR_CONFIDENCE_THRESHOLD + OCR_REOCR_CROSS_MARGIN:
+        return True
+    numeros = _numeric_tokens(texto)
+    return bool(numeros) and numeros == _numeric_tokens(atual["texto"]) and confianca >= OCR_CONFIDENCE_THRESHOLD
+
+
+def reocr_low_confidence(image_path: str, linhas: list) -> list:
+    """
+    Reprocessa apenas as linhas com confiança abaixo de OCR_CONFIDENCE_THRESHOLD,
+    recortando a região da linha e ampliando em OCR_REOCR_SCALE. A leitura
+    nova só substitui a original segundo _accept_reocr.
+    """
+    baixas = [i for i, linha in enumerate(linhas) if linha["confianca"] < OCR_CONFIDENCE_THRESHOLD and linha.get("caixa")]
+    if not baixas or OCR_REOCR_MAX_LINES <= 0 or not PIL_AVAILABLE:
+        return linhas
+    
+    # Priorizar as piores linhas
+    baixas = sorted(baixas, key=lambda i: linhas[i]["confianca"])[:OCR_REOCR_MAX_LINES]
+    print(f"🔁 Reprocessando {len(baixas)} linhas com confiança < {OCR_CONFIDENCE_THRESHOLD}...")
+    inicio = time.time()
+    melhoradas = 0
+    
+    with Image.open(image_path) as imagem:
+        imagem = imagem.convert("RGB")
+        for i in baixas:
+            linha = linhas[i]
+            x0, y0, x1, y1 = linha["caixa"]
+            margem = max(2, int((y1 - y0) * 0.2))
+            caixa = (max(0, int(x0) - margem), max(0, int(y0) - margem),
+                     min(imagem.width, int(x1) + margem), min(imagem.height, int(y1) + margem))
+            if caixa[2] <= caixa[0] or caixa[3] <= caixa[1]:
+                continue
+            recorte = imagem.crop(caixa)
+            recorte = recorte.resize(
+                (max(1, int(recorte.width * OCR_REOCR_SCALE)), max(1, int(recorte.height * OCR_REOCR_SCALE))),
+                Image.LANCZOS,
+            )
+            
+            melhor = linha
+            for texto, confianca, engine in _reocr_candidates(recorte, linha.get("engine", OCR_ENGINE)):
+                if _accept_reocr(melhor, texto, confianca, engine):
+                    melhor = {**linha, "texto": texto, "confianca": confianca, "engine": engine, "reprocessada": True}
+                if melhor["confianca"] >= OCR_CONFIDENCE_THRESHOLD:
+                    break
+            if melhor is not linha:
+                print(f"   '{linha['texto']}' ({linha['confianca']:.2f}) -> '{melhor['texto']}' ({melhor['confianca']:.2f}, {melhor['engine']})")
+                linhas[i] = melhor
+                melhoradas += 1
+    
+    print(f"✅ {melhoradas}/{len(baixas)} linhas melhoradas em {time.time() - inicio:.1f}s")
+    return linhas
+
+
+def attach_ocr_confidence(data: dict, linhas: list) -> dict:
+    """
+    Anexa a confiança do OCR ao resultado da extração: resumo em "ocr" e,
+    em cada disciplina reconhecida, "ocr_confianca" (menor confiança entre
+    as linhas da disciplina na tabela)
+    """
+    if not isinstance(data, dict) or not linhas:
+        return data
+    
+    por_disciplina = {}
+    for linha in linhas:
+        texto = linha["texto"].strip()
+        canonico = DISCIPLINA_INDEX.match_line(texto) if texto else None
+        if not canonico:
+            continue
+        
+        # Linha da tabela: tudo cujo centro vertical cai na faixa do nome
+        _, y0, _, y1 = linha["caixa"]
+        folga = (y1 - y0) / 2
+        bloco = [
+            outra for outra in linhas
+            if y0 - folga <= (outra["caixa"][1] + outra["caixa"][3]) / 2 <= y1 + folga
+        ]
+        
+        chave = normalize_string(canonico)
+        confianca = min(outra["confianca"] for outra in bloco)
+        por_disciplina[chave] = min(por_disciplina.get(chave, 1.0), confianca)
+    
+    for disciplina in data.get("disciplinas", []):
+        if isinstance(disciplina, dict) and isinstance(disciplina.get("nome"), str):
+            confianca = por_disciplina.get(DISCIPLINA_INDEX.key(disciplina["nome"]))
+            if confianca is not None:
+                disciplina["ocr_confianca"] = round(confianca, 3)
+    
+    confiancas = [linha["confianca"] for linha in linhas]
+    # Engine que de fato leu as linhas (fallback para Tesseract, releituras pelo outro engine)
+    engines = sorted({linha.get("engine", OCR_ENGINE) for linha in linhas})
+    data["ocr"] = {
+        "engine": "+".join(engines),
+        "linhas": len(linhas),
+        "confianca_media": round(sum(confiancas) / len(confiancas), 3),
+        "confianca_minima": round(min(confiancas), 3),
+        "linhas_reprocessadas": sum(1 for linha in linhas if linha.get("reprocessada")),
+        "linhas_baixa_confianca": [
+            {"texto": linha["texto"], "confianca": round(linha["confianca"], 3)}
+            for linha in linhas if linha["confianca"] < OCR_CONFIDENCE_THRESHOLD
+        ],
+    }
+    return data
+
+
+def strip_markdown_json(text: str) -> str:
+    """Remove blocos de código markdown (```json ... ```) da resposta do LLM"""
+    text = text.strip()
+    if "```json" in text:
+        text = text.split("```json")[1].split("```")[0].strip()
+    elif "```" in text:
+        text = text.split("```")[1].split("```")[0].strip()
+    return text
+
+
+def try_repair_json(text):
+    """Tenta reparar JSON incompleto fechando estruturas abertas"""
+    text = text.strip()
+    original_text = text
+    
+    # Contar aberturas e fechamentos
+    open_braces = text.count('{')
+    close_braces = text.count('}')
+    open_brackets = text.count('[')
+    close_brackets = text.count(']')
+    
+    # Fechar estruturas abertas
+    missing_braces = open_braces - close_braces
+    missing_brackets = open_brackets - close_brackets
+    
+    # Se estiver no meio de uma string, tentar fechar
+    quote_count = text.count('"')
+    if quote_count % 2 != 0:
+        # String não fechada, encontrar a última abertura de string
+        last_open_quote = text.rfind('"')
+        if last_open_quote > 0:
+            # Verificar o contexto antes da última aspas
+            before_quote = text[:last_open_quote]
+            # Se há um número par de aspas antes, então a última é uma abertura
+            if before_quote.count('"') % 2 == 0:
+                # Estamos no meio de uma string, fechar ela
+                # Encontrar onde a string deveria terminar (antes de : ou , ou })
+                remaining = text[last_open_quote+1:]
+                # Se não há mais nada ou só espaços, fechar a string
+                if not remaining.strip() or remaining.strip().startswith((':', ',', '}', ']')):
+                    # Inserir aspas de fechamento antes do próximo caractere
+                    if remaining.strip():
+                        next_char_pos = len(text) - len(remaining.lstrip())
+                        text = text[:next_char_pos] + '"' + text[next_char_pos:]
+                    else:
+                        text = text + '"'
+    
+    # Remover vírgulas finais antes de fechar estruturas
+    text = text.rstrip()
+    while text.endswith(','):
+        text = text[:-1].rstrip()
+    
+    # Fechar arrays abertos
+    if missing_brackets > 0:
+        text += ']' * missing_brackets
+    
+    # Fechar objetos abertos
+    if missing_braces > 0:
+        text += '}' * missing_braces
+    
+    # Se ainda estiver quebrado, tentar uma abordagem mais agressiva
+    # Remover a última disciplina incompleta se necessário
+    if missing_braces > 0 or missing_brackets > 0:
+        # Tentar encontrar o último objeto de disciplina completo
+        last_complete_disciplina = original_text.rfind('},')
+        if last_complete_disciplina > 0:
+            # Pegar tudo até o último objeto completo + fechar arrays/objetos
+            text = original_text[:last_complete_disciplina+1]
+            # Fechar o array de disciplinas
+            if text.count('[') > text.count(']'):
+                text += ']'
+            # Fechar o objeto principal
+            if text.count('{') > text.count('}'):
+                text += '}'
+    
+    return text
+
+
+def parse_llm_json(response_text: str) -> dict:
+    """
+    Parseia o JSON retornado pelo LLM, extraindo e reparando se necessário
+    """
+    response_text = strip_markdown_json(response_text)
+    
+    data = None
+    json_parse_attempts = 0
+    max_json_attempts = 3
+    
+    while json_parse_attempts < max_json_attempts:
+        try:
+            data = json.loads(response_text)
+            break  # Sucesso
+        except json.JSONDecodeError as e:
+            json_parse_attempts += 1
+            print(f"⚠️  Erro ao parsear JSON (tentativa {json_parse_attempts}/{max_json_attempts}): {e}")
+            
+            if json_parse_attempts == 1:
+                # Primeira tentativa: tentar extrair JSON do texto
+                json_match = re.search(r'\{.*', response_text, re.DOTALL)
+                if json_match:
+                    response_text = json_match.group()
+                    print("🔍 Tentando extrair JSON do texto...")
+                    continue
+            
+            elif json_parse_attempts == 2:
+                # Segunda tentativa: tentar reparar JSON incompleto
+                print("🔧 Tentando reparar JSON incompleto...")
+                response_text = try_repair_json(response_text)
+                continue
+            
+            else:
+                # Última tentativa: mostrar erro detalhado
+                print(f"❌ Não foi possível parsear JSON após {max_json_attempts} tentativas")
+                print(f"📄 Resposta recebida (primeiros 1000 chars): {response_text[:1000]}")
+                print(f"📄 Resposta recebida (últimos 500 chars): {response_text[-500:]}")
+                
+                # Tentar extrair pelo menos algumas informações
+                # Tentar extrair disciplinas mesmo com JSON quebrado
+                disciplina_matches = re.findall(r'"nome"\s*:\s*"([^"]+)"', response_text)
+                if disciplina_matches:
+                    print(f"⚠️  Encontradas {len(disciplina_matches)} disciplinas mesmo com JSON quebrado")
+                    print(f"📋 Disciplinas encontradas: {disciplina_matches[:5]}...")
+                
+                raise HTTPException(
+                    status_code=500, 
+                    detail=f"Não foi possível extrair JSON válido da resposta do LLM. O JSON pode estar incompleto. Erro: {str(e)}"
+                )
+    
+    if data is None:
+        raise HTTPException(status_code=500, detail="Não foi possível parsear JSON após todas as tentativas")
+    
+    return data
+
+
+# Tempos das últimas chamadas ao LLM (TTFT = tempo até o primeiro token)
+LLM_TIMINGS = deque(maxlen=100)
+
+
+def stream_complete_timed(prompt: str) -> str:
+    """
+    Completa o prompt via streaming, medindo o tempo até o primeiro token
+    (TTFT) e o tempo total. Retorna o texto completo.
+    """
+    inicio = time.perf_counter()
+    ttft = None
+    ultimo = None
+    for ultimo in Settings.llm.stream_complete(prompt):
+        if ttft is None and ultimo.delta:
+            ttft = time.perf_counter() - inicio
+    total = time.perf_counter() - inicio
+    
+    LLM_TIMINGS.append({"ttft": ttft if ttft is not None else total, "total": total, "prompt_chars": len(prompt)})
+    print(f"⚡ TTFT: {(ttft if ttft is not None else total) * 1000:.0f} ms | total: {total:.1f}s ({LLM_PROVIDER})")
+    return ultimo.text if ultimo is not None else ""
+
+
+def query_index_timed(ocr_text: str, prompt: str) -> str:
+    """
+    Caminho do prompt v1 na OpenAI: indexa o texto do OCR em um
+    VectorStoreIndex e consulta com o prompt, via streaming, medindo o TTFT
+    (incluindo embeddings e recuperação, que fazem parte da latência real).
+    """
+    inicio = time.perf_counter()
+    ttft = None
+    partes = []
+    index = VectorStoreIndex.from_documents([Document(text=ocr_text)])
+    resposta = index.as_query_engine(streaming=True).query(prompt)
+    for parte in resposta.response_gen:
+        if ttft is None and parte:
+            ttft = time.perf_counter() - inicio
+        partes.append(parte)
+    total = time.perf_counter() - inicio
+    
+    LLM_TIMINGS.append({"ttft": ttft if ttft is not None else total, "total": total, "prompt_chars": len(prompt)})
+    print(f"⚡ TTFT: {(ttft if ttft is not None else total) * 1000:.0f} ms | total: {total:.1f}s ({LLM_PROVIDER}, VectorStoreIndex)")
+    return "".join(partes)
+
+
+def complete_with_retry(full_prompt: str, max_retries: int = 3) -> str:
+    """
+    Envia o prompt ao LLM com retry e backoff exponencial, repetindo também
+    quando a resposta parece ser um JSON truncado
+    """
+    retry_delay = 2  # segundos
+    response_text = None
+    
+    for attempt in range(max_retries):
+        try:
+            print(f"🔄 Tentativa {attempt + 1}/{max_retries}...")
+            print(f"📤 Enviando prompt para {LLM_PROVIDER} (tamanho: {len(full_prompt)} chars)...")
+            
+            response_text = stream_complete_timed(full_prompt)
+            
+            if response_text and len(response_text) > 0:
+                print(f"✅ Resposta recebida do {LLM_PROVIDER} ({len(response_text)} chars)")
+                
+                # Verificar se o JSON parece estar completo
+                response_clean = strip_markdown_json(response_text)
+                
+                # Verificar se parece JSON completo (tem chaves de abertura e fechamento balanceadas)
+                open_braces = response_clean.count('{')
+                close_braces = response_clean.count('}')
+                
+                # Se tiver mais de 2 chaves abertas e estiver desbalanceado, pode estar incompleto
+                if open_braces > 2 and open_braces != close_braces:
+                    print(f"⚠️  JSON pode estar incompleto (abertas: {open_braces}, fechadas: {close_braces})")
+                    # Tentar validar rapidamente
+                    try:
+                        json.loads(response_clean)
+                        print("✅ JSON válido apesar do desbalanceamento")
+                        break  # JSON válido, sair do loop
+                    except json.JSONDecodeError:
+                        if attempt < max_retries - 1:
+                            print("🔄 JSON incompleto detectado, tentando novamente...")
+                            raise Exception("JSON incompleto na resposta")
+                        else:
+                            print("⚠️  JSON incompleto, mas última tentativa. Tentando reparar depois...")
+                            break  # Continuar para tentar reparar depois
+                else:
+                    break  # JSON parece completo, sair do loop
+            else:
+                raise Exception(f"Resposta vazia do {LLM_PROVIDER}")
+                
+        except Exception as e:
+            error_msg = str(e)
+            error_type = type(e).__name__
+            print(f"⚠️  Erro na tentativa {attempt + 1}/{max_retries} ({error_type}): {error_msg}")
+            
+            # Verificar se é erro de conexão
+            if "disconnected" in error_msg.lower() or "connection" in error_msg.lower():
+                print(f"🔌 Erro de conexão detectado. O {LLM_PROVIDER} pode ter desconectado.")
+                if attempt < max_retries - 1:
+                    print("💡 Tentando reconectar...")
+            
+            if attempt < max_retries - 1:
+                # Aguardar antes de tentar novamente
+                print(f"⏳ Aguardando {retry_delay} segundos antes de tentar novamente...")
+                time.sleep(retry_delay)
+                retry_delay *= 2  # Backoff exponencial
+            else:
+                # Última tentativa falhou
+                print(f"❌ Todas as tentativas falharam")
+                dica = " Certifique-se de que o Ollama está rodando: ollama serve." if LLM_PROVIDER == "ollama" else ""
+                raise HTTPException(
+                    status_code=500,
+                    detail=f"Erro ao processar com {LLM_PROVIDER} após {max_retries} tentativas.{dica} Tipo de erro: {error_type}. Mensagem: {error_msg}"
+                )
+    
+    if not response_text:
+        raise HTTPException(
+            status_code=500,
+            detail=f"Não foi possível obter resposta do {LLM_PROVIDER} após todas as tentativas"
+        )
+    
+    return response_text
+
+
+# Extração em seções paralelas (boletins grandes)
+# "single": um único prompt; "sectioned": sempre em seções; "auto": seções
+# quando o boletim tem pelo menos LLM_SECTION_MIN_DISCIPLINAS disciplinas
+LLM_EXTRACTION_MODE = os.getenv("LLM_EXTRACTION_MODE", "auto")
+LLM_SECTION_MIN_DISCIPLINAS = int(os.getenv("LLM_SECTION_MIN_DISCIPLINAS", 20))
+LLM_SECTION_DISCIPLINAS = int(os.getenv("LLM_SECTION_DISCIPLINAS", 6))  # disciplinas por seção
+LLM_SECTION_WORKERS = int(os.getenv("LLM_SECTION_WORKERS", 4))
+
+# Títulos de coluna da tabela de notas ("DISCIPLINA", "1ª AV", "FALTAS", "MÉDIA"...)
+_TITULO_COLUNA = re.compile(
+    r"^(disciplinas?|componentes?( curricular(es)?)?|[1-4] ?[aoº°ª]? ?(av|aval|avaliacao|bim|bimestre|nota|trim)\w*"
+    r"|(av|nota|bim)\w* ?[1-4]|faltas?|f|medias?( \w+)?|mf|ma|total|pontos|recuperacao|rec|situacao|resultado)$"
+)
+_LINHA_NUMERICA = re.compile(r"^[\d\s.,/%-]*$")
+# Linha inteira de uma disciplina (Tesseract): nome seguido de ao menos duas notas
+_LINHA_DE_NOTAS = re.compile(r"^[^\d:]+?(\s+[\d.,-]+){2,}\s*$")
+
+
+def _is_column_title(linha: str) -> bool:
+    """Linha composta apenas por títulos de coluna (um ou vários na mesma linha)"""
+    texto = normalize_string(linha)
+    if not texto:
+        return False
+    if _TITULO_COLUNA.match(texto):
+        return True
+    partes = [p for p in re.split(r"\s{2,}|\t|\|", linha) if p.strip()]
+    return len(partes) > 1 and all(_TITULO_COLUNA.match(normalize_string(p)) for p in partes)
+
+
+def split_ocr_sections(ocr_text: str):
+    """
+    Divide o texto OCR em cabeçalho e seções de linhas de disciplinas.
+    Uma nova disciplina começa em cada linha cujo início é reconhecido pelo
+    DISCIPLINA_INDEX (PaddleOCR devolve o nome sozinho, Tesseract a linha inteira).
+    A tabela começa na linha de títulos das colunas; linhas entre os títulos e a
+    primeira disciplina conhecida (ex.: "ARTE" fora do índice) vão para a primeira
+    seção em vez de ficarem no cabeçalho.
+    Retorna (cabeçalho, colunas da tabela, lista de seções, qtd de disciplinas).
+    """
+    linhas = ocr_text.splitlines()
+    inicios = [i for i, linha in enumerate(linhas) if linha.strip() and DISCIPLINA_INDEX.match_line(linha.strip())]
+    if not inicios:
+        return ocr_text, "", [], 0
+    
+    # Início da tabela: primeira linha de títulos antes da primeira disciplina conhecida
+    titulos = [i for i in range(inicios[0]) if _is_column_title(linhas[i])]
+    if titulos:
+        # A coluna "Disciplina" abre a tabela; títulos antes dela ("1º Bimestre") são do cabeçalho
+        primeira_coluna = [i for i in titulos if normalize_string(linhas[i]).startswith(("disciplina", "componente"))]
+        inicio_tabela = primeira_coluna[0] if primeira_coluna else titulos[0]
+        fim_titulos = inicio_tabela
+        while fim_titulos < inicios[0] and (_is_column_title(linhas[fim_titulos]) or not linhas[fim_titulos].strip()):
+            fim_titulos += 1
+    else:
+        # Sem títulos: recua sobre linhas de disciplinas fora do índice (nome seguido de notas)
+        inicio_tabela = inicios[0]
+        i = inicios[0] - 1
+        while i >= 0:
+            if _LINHA_DE_NOTAS.match(linhas[i].strip()):
+                inicio_tabela = i
+                i -= 1
+                continue
+            j = i
+            while j >= 0 and linhas[j].strip() and _LINHA_NUMERICA.match(linhas[j].strip()):
+                j -= 1
+            if j == i or j < 0 or _LINHA_NUMERICA.match(linhas[j].strip()) or ":" in linhas[j]:
+                break
+            inicio_tabela = j
+            i = j - 1
+        fim_titulos = inicio_tabela
     
-    # Prompt otimizado para extração estruturada
-    extraction_prompt = """
+    cabecalho = "\n".join(linhas[:inicio_tabela])
+    # Só os títulos das colunas são repetidos em cada seção, nunca linhas de notas
+    colunas = "\n".join(linhas[inicio_tabela:fim_titulos])
+    
+    inicios[0] = fim_titulos
+    secoes = []
+    for i in range(0, len(inicios), LLM_SECTION_DISCIPLINAS):
+        inicio = inicios[i]
+        fim = inicios[i + LLM_SECTION_DISCIPLINAS] if i + LLM_SECTION_DISCIPLINAS < len(inicios) else len(linhas)
+        secoes.append("\n".join(linhas[inicio:fim]))
+    
+    return cabecalho, colunas, secoes, len(inicios)
+
+
+def extract_sections_parallel(cabecalho: str, colunas: str, secoes: list, versao: Optional[str] = None) -> dict:
+    """
+    Envia cabeçalho e seções de disciplinas ao LLM em paralelo e mescla os
+    JSONs parciais em um único resultado (na ordem original das seções)
+    """
+    prompts = [build_header_prompt(cabecalho, versao)]
+    prompts += [build_section_prompt(colunas, secao, versao) for secao in secoes]
+    
+    def processar(prompt):
+        return parse_llm_json(complete_with_retry(prompt))
+    
+    inicio = time.time()
+    with ThreadPoolExecutor(max_workers=LLM_SECTION_WORKERS) as executor:
+        resultados = list(executor.map(processar, prompts))
+    print(f"⏱️  {len(prompts)} seções processadas em {time.time() - inicio:.1f}s")
+    
+    data = {}
+    disciplinas = []
+    for parcial in resultados:
+        if not isinstance(parcial, dict):
+            continue
+        for campo, valor in parcial.items():
+            if campo == "disciplinas":
+                if isinstance(valor, list):
+                    disciplinas.extend(valor)
+            elif valor is not None and data.get(campo) is None:
+                data[campo] = valor
+    data["disciplinas"] = disciplinas
+    return data
+
+
+# Templates de prompt de extração, versionados e montados uma única vez.
+# A parte fixa vem primeiro e o texto do OCR no final, para que o prefixo seja
+# idêntico entre requisições: o Ollama reaproveita o KV cache do prefixo
+# (com o modelo mantido carregado por OLLAMA_KEEP_ALIVE). O prompt caching da
+# OpenAI só vale para prefixos idênticos de 1024+ tokens, que nenhum dos
+# prefixos abaixo atinge: lá o ganho do v2 vem só do prompt menor.
+# "v1": prompt original (OpenAI via VectorStoreIndex); "v2": compacto, direto no LLM
+PROMPT_VERSION = os.getenv("PROMPT_VERSION", "v2")
+
+EXTRACTION_PROMPTS = {
+    "v1": """
 Você é um especialista em análise de boletins escolares. Extraia TODOS os dados do boletim e retorne APENAS um JSON válido, sem texto adicional.
 
 Estrutura esperada do JSON:
@@ -438,27 +1514,7 @@ REGRAS IMPORTANTES:
 7. Para faltas, use 0 se não houver faltas ou o número exato de faltas
 
 Disciplinas comuns (podem variar por série):
-- EMPREENDEDORISMO
-- FILOSOFIA
-- GEOGRAFIA
-- HISTÓRIA
-- SOCIOLOGIA
-- BIOLOGIA (pode ter subtabelas: Biologia I, Biologia II)
-- FÍSICA (pode ter subtabelas: Física I, Física II)
-- QUÍMICA
-- REDAÇÃO
-- ÉTICA E CIDADANIA
-- CIÊNCIAS
-- EDUCAÇÃO FÍSICA
-- ENSINO DA ARTE
-- ESPANHOL
-- INGLÊS
-- LÍNGUA PORTUGUESA (pode ter subtabelas: Literatura, Análise Linguística, Produção de Texto)
-- MATEMÁTICA
-- PROJETO DE VIDA
-- UNIDADE CURRICULAR DE HUMANAS
-- UNIDADE CURRICULAR DE NATUREZA
-- TRAJETÓRIA DE LEITURA E ESCRITA
+""" + DISCIPLINAS_PROMPT + """
 
 IMPORTANTE: 
 - Se uma disciplina tiver subtabelas (ex: Biologia I / Biologia II), trate cada uma como uma disciplina separada
@@ -466,266 +1522,332 @@ IMPORTANTE:
 - Extraia TODAS as disciplinas encontradas, não apenas as listadas acima
 
 Extraia todos os dados visíveis no boletim e retorne o JSON completo.
-"""
-    
+""",
+    "v2": """Extraia os dados do boletim escolar abaixo. Responda APENAS com JSON válido, sem markdown e sem explicações, no formato:
+{"aluno":str,"matricula":str,"turma":str,"ano":int,"bimestre":str,"disciplinas":[{"nome":str,"faltas":int,"notas":[n1,n2,n3],"pontos_extras":num,"media_provisoria":num|null,"media_parcial":num|null}]}
+Regras:
+- Inclua TODAS as disciplinas; subtabelas (ex: Biologia I/II, Física I/II, Literatura, Análise Linguística, Produção de Texto) são disciplinas separadas
+- Nome da disciplina exatamente como aparece
+- notas: 1ª, 2ª e 3ª AV; vazio ou "-" = null
+- faltas: 0 se não houver""",
+}
+
+# Prompts do modo em seções (cabeçalho e trecho da tabela), nas mesmas versões
+SECTION_PROMPTS = {
+    "v1": {
+        "cabecalho": """
+Você é um especialista em análise de boletins escolares. Extraia APENAS os dados de identificação do cabeçalho do boletim e retorne APENAS um JSON válido, sem texto adicional, sem markdown.
+
+Estrutura esperada do JSON:
+{
+  "aluno": "NOME COMPLETO DO ALUNO",
+  "matricula": "NÚMERO DA MATRÍCULA",
+  "turma": "CÓDIGO DA TURMA (ex: 7A, 7B)",
+  "ano": 2024,
+  "bimestre": "1º Bimestre" ou "2º Bimestre" etc
+}
+
+Use null para campos que não aparecem no texto.
+""",
+        "secao": """
+Você é um especialista em análise de boletins escolares. O texto abaixo é um TRECHO da tabela de notas de um boletim. Extraia TODAS as disciplinas do trecho e retorne APENAS um JSON válido, sem texto adicional, sem markdown.
+
+Estrutura esperada do JSON:
+{
+  "disciplinas": [
+    {
+      "nome": "NOME DA DISCIPLINA (exatamente como aparece)",
+      "faltas": 0,
+      "notas": [10.0, 9.5, null],  // Array com 3 notas (1ª AV, 2ª AV, 3ª AV), use null se não houver
+      "pontos_extras": 0,
+      "media_provisoria": 9.75,  // Se disponível no boletim
+      "media_parcial": 10.0      // Se disponível no boletim
+    }
+  ]
+}
+
+REGRAS IMPORTANTES:
+1. As notas devem ser números decimais ou null se não houver nota
+2. Mantenha os nomes das disciplinas EXATAMENTE como aparecem (com acentos e maiúsculas)
+3. Subtabelas (ex: Biologia I / Biologia II) são disciplinas separadas com seu nome completo
+4. Valores vazios ou traços (-) devem ser null
+5. Para faltas, use 0 se não houver faltas ou o número exato de faltas
+""",
+    },
+    "v2": {
+        "cabecalho": """Extraia apenas os dados de identificação do cabeçalho do boletim escolar abaixo. Responda APENAS com JSON válido, sem markdown e sem explicações, no formato:
+{"aluno":str,"matricula":str,"turma":str,"ano":int,"bimestre":str}
+Use null para campos que não aparecem no texto.""",
+        "secao": """O texto abaixo é um TRECHO da tabela de notas de um boletim escolar. Extraia todas as disciplinas do trecho. Responda APENAS com JSON válido, sem markdown e sem explicações, no formato:
+{"disciplinas":[{"nome":str,"faltas":int,"notas":[n1,n2,n3],"pontos_extras":num,"media_provisoria":num|null,"media_parcial":num|null}]}
+Regras:
+- Subtabelas (ex: Biologia I/II, Física I/II) são disciplinas separadas
+- Nome da disciplina exatamente como aparece
+- notas: 1ª, 2ª e 3ª AV; vazio ou "-" = null
+- faltas: 0 se não houver""",
+    },
+}
+
+if PROMPT_VERSION not in EXTRACTION_PROMPTS:
+    print(f"⚠️  PROMPT_VERSION '{PROMPT_VERSION}' desconhecida. Usando 'v2'.")
+    PROMPT_VERSION = "v2"
+print(f"✅ Prompt de extração: {PROMPT_VERSION} ({len(EXTRACTION_PROMPTS[PROMPT_VERSION])} chars)")
+
+OCR_TEXT_MARKER = "\n\nTexto extraído do boletim:\n\n"
+
+# Conexão com o Ollama verificada uma vez por processo (uma chamada extra
+# por requisição custava latência e descartava o prefixo em cache)
+_ollama_verificado = False
+
+
+def uses_vector_index(versao: Optional[str] = None) -> bool:
+    """v1 na OpenAI passa pelo VectorStoreIndex; os demais vão direto ao LLM"""
+    return LLM_PROVIDER == "openai" and (versao or PROMPT_VERSION) == "v1"
+
+
+def build_extraction_prompt(ocr_text: str, versao: Optional[str] = None) -> str:
+    """Prompt completo: prefixo fixo da versão + texto do OCR no final"""
+    return EXTRACTION_PROMPTS[versao or PROMPT_VERSION] + OCR_TEXT_MARKER + ocr_text
+
+
+def build_header_prompt(cabecalho: str, versao: Optional[str] = None) -> str:
+    """Prompt do cabeçalho no modo em seções (prefixo fixo primeiro)"""
+    return SECTION_PROMPTS[versao or PROMPT_VERSION]["cabecalho"] + "\n\nTexto do cabeçalho do boletim:\n\n" + cabecalho
+
+
+def build_section_prompt(colunas: str, secao: str, versao: Optional[str] = None) -> str:
+    """Prompt de um trecho da tabela: prefixo fixo, títulos das colunas e o trecho no final"""
+    return (
+        SECTION_PROMPTS[versao or PROMPT_VERSION]["secao"]
+        + f"\n\nColunas da tabela:\n{colunas}\n\nTrecho do boletim:\n\n{secao}"
+    )
+
+
+def check_ollama_once():
+    """Verifica (uma vez) se o Ollama está respondendo"""
+    global _ollama_verificado
+    if _ollama_verificado:
+        return
     try:
-        # Extrair texto usando OCR
-        ocr_text = extract_text_with_ocr(image_path)
-        
-        # Criar documento do LlamaIndex com o texto extraído
-        doc = Document(text=ocr_text)
-        docs = [doc]
-        
-        print(f"📝 Texto OCR preparado para processamento com LLM")
+        print("🔍 Verificando conexão com Ollama...")
+        Settings.llm.complete("test")
+        print("✅ Ollama está respondendo")
+        _ollama_verificado = True
+    except Exception as e:
+        print(f"⚠️  Aviso: Ollama pode não estar respondendo corretamente: {e}")
+        print("💡 Certifique-se de que o Ollama está rodando: ollama serve")
+
+
+def extract_boletim_data_from_text(ocr_text: str, versao: Optional[str] = None) -> dict:
+    """
+    Extrai dados estruturados do texto OCR do boletim usando LlamaIndex
+    """
+    versao = versao or PROMPT_VERSION
+    extraction_prompt = EXTRACTION_PROMPTS[versao]
+    
+    print(f"📝 Texto OCR preparado para processamento com LLM (prompt {versao})")
+    
+    # Boletins grandes: dividir em seções menores processadas em paralelo
+    if LLM_EXTRACTION_MODE != "single":
+        cabecalho, colunas, secoes, qtd_disciplinas = split_ocr_sections(ocr_text)
+        if len(secoes) > 1 and (LLM_EXTRACTION_MODE == "sectioned" or qtd_disciplinas >= LLM_SECTION_MIN_DISCIPLINAS):
+            print(f"🧩 Modo em seções: {qtd_disciplinas} disciplinas em {len(secoes)} seções + cabeçalho")
+            data = extract_sections_parallel(cabecalho, colunas, secoes, versao)
+            print(f"✅ Dados extraídos: {len(data.get('disciplinas', []))} disciplinas")
+            return data
+    
+    if uses_vector_index(versao):
+        # v1: OpenAI via VectorStoreIndex (precisa de embeddings)
+        print("🤖 Processando com OpenAI (usando VectorStoreIndex)...")
+        try:
+            response_text = query_index_timed(ocr_text, extraction_prompt)
+        except Exception as e:
+            error_msg = str(e)
+            print(f"❌ Erro ao processar com OpenAI: {error_msg}")
+            raise
+    else:
+        # Usar LLM diretamente, sem VectorStoreIndex (não precisa de embeddings)
+        print(f"🤖 Processando com {LLM_PROVIDER} (modo direto, sem embeddings)...")
+        print(f"📊 Tamanho do texto OCR: {len(ocr_text)} caracteres")
         
-        # Para Ollama, usar LLM diretamente sem VectorStoreIndex (mais simples e não precisa de embeddings)
         if LLM_PROVIDER == "ollama":
-            print("🤖 Processando com Ollama (modo direto, sem embeddings)...")
-            print(f"📊 Tamanho do texto OCR: {len(ocr_text)} caracteres")
-            
             # Limitar tamanho do texto se for muito grande (evitar timeout)
             max_text_length = 8000  # Limite razoável para evitar timeout
             if len(ocr_text) > max_text_length:
                 print(f"⚠️  Texto muito grande ({len(ocr_text)} chars), truncando para {max_text_length} chars...")
                 ocr_text = ocr_text[:max_text_length] + "\n[... texto truncado ...]"
             
-            # Verificar se o Ollama está respondendo (teste rápido)
-            try:
-                print("🔍 Verificando conexão com Ollama...")
-                test_response = Settings.llm.complete("test")
-                print("✅ Ollama está respondendo")
-            except Exception as e:
-                print(f"⚠️  Aviso: Ollama pode não estar respondendo corretamente: {e}")
-                print("💡 Certifique-se de que o Ollama está rodando: ollama serve")
-            
-            # Tentar processar com retry
-            max_retries = 3
-            retry_delay = 2  # segundos
-            response_text = None
-            
-            for attempt in range(max_retries):
-                try:
-                    # Usar o LLM diretamente com o texto completo
-                    full_prompt = f"{extraction_prompt}\n\nTexto extraído do boletim:\n\n{ocr_text}"
-                    print(f"🔄 Tentativa {attempt + 1}/{max_retries}...")
-                    print(f"📤 Enviando prompt para Ollama (tamanho: {len(full_prompt)} chars)...")
-                    
-                    response = Settings.llm.complete(full_prompt)
-                    response_text = str(response)
-                    
-                    if response_text and len(response_text) > 0:
-                        print(f"✅ Resposta recebida do Ollama ({len(response_text)} chars)")
-                        
-                        # Verificar se o JSON parece estar completo
-                        response_clean = response_text.strip()
-                        # Remover markdown se houver
-                        if "```json" in response_clean:
-                            response_clean = response_clean.split("```json")[1].split("```")[0].strip()
-                        elif "```" in response_clean:
-                            response_clean = response_clean.split("```")[1].split("```")[0].strip()
-                        
-                        # Verificar se parece JSON completo (tem chaves de abertura e fechamento balanceadas)
-                        open_braces = response_clean.count('{')
-                        close_braces = response_clean.count('}')
-                        
-                        # Se tiver mais de 2 chaves abertas e estiver desbalanceado, pode estar incompleto
-                        if open_braces > 2 and open_braces != close_braces:
-                            print(f"⚠️  JSON pode estar incompleto (abertas: {open_braces}, fechadas: {close_braces})")
-                            # Tentar validar rapidamente
-                            try:
-                                json.loads(response_clean)
-                                print("✅ JSON válido apesar do desbalanceamento")
-                                break  # JSON válido, sair do loop
-                            except json.JSONDecodeError:
-                                if attempt < max_retries - 1:
-                                    print("🔄 JSON incompleto detectado, tentando novamente...")
-                                    raise Exception("JSON incompleto na resposta")
-                                else:
-                                    print("⚠️  JSON incompleto, mas última tentativa. Tentando reparar depois...")
-                                    break  # Continuar para tentar reparar depois
-                        else:
-                            break  # JSON parece completo, sair do loop
-                    else:
-                        raise Exception("Resposta vazia do Ollama")
-                        
-                except Exception as e:
-                    error_msg = str(e)
-                    error_type = type(e).__name__
-                    print(f"⚠️  Erro na tentativa {attempt + 1}/{max_retries} ({error_type}): {error_msg}")
-                    
-                    # Verificar se é erro de conexão
-                    if "disconnected" in error_msg.lower() or "connection" in error_msg.lower():
-                        print("🔌 Erro de conexão detectado. O Ollama pode ter desconectado.")
-                        if attempt < max_retries - 1:
-                            print("💡 Tentando reconectar...")
-                    
-                    if attempt < max_retries - 1:
-                        # Aguardar antes de tentar novamente
-                        print(f"⏳ Aguardando {retry_delay} segundos antes de tentar novamente...")
-                        time.sleep(retry_delay)
-                        retry_delay *= 2  # Backoff exponencial
-                    else:
-                        # Última tentativa falhou
-                        print(f"❌ Todas as tentativas falharam")
-                        raise HTTPException(
-                            status_code=500,
-                            detail=f"Erro ao processar com Ollama após {max_retries} tentativas. Certifique-se de que o Ollama está rodando: ollama serve. Tipo de erro: {error_type}. Mensagem: {error_msg}"
-                        )
-            
-            if not response_text:
-                raise HTTPException(
-                    status_code=500,
-                    detail="Não foi possível obter resposta do Ollama após todas as tentativas"
-                )
-        else:
-            # Para OpenAI, usar VectorStoreIndex (precisa de embeddings)
-            print("🤖 Processando com OpenAI (usando VectorStoreIndex)...")
-            try:
-                # Criar índice vetorial
-                index = VectorStoreIndex.from_documents(docs)
-                query_engine = index.as_query_engine()
-                response = query_engine.query(extraction_prompt)
-                response_text = str(response)
-            except Exception as e:
-                error_msg = str(e)
-                print(f"❌ Erro ao processar com OpenAI: {error_msg}")
-                raise
-        
-        # Parsear resposta JSON (response_text já foi definido acima)
-        response_text = response_text.strip()
-        
-        # Remover markdown code blocks se houver
-        if "```json" in response_text:
-            response_text = response_text.split("```json")[1].split("```")[0].strip()
-        elif "```" in response_text:
-            response_text = response_text.split("```")[1].split("```")[0].strip()
-        
-        # Função para tentar reparar JSON incompleto
-        def try_repair_json(text):
-            """Tenta reparar JSON incompleto fechando estruturas abertas"""
-            text = text.strip()
-            original_text = text
-            
-            # Contar aberturas e fechamentos
-            open_braces = text.count('{')
-            close_braces = text.count('}')
-            open_brackets = text.count('[')
-            close_brackets = text.count(']')
-            
-            # Fechar estruturas abertas
-            missing_braces = open_braces - close_braces
-            missing_brackets = open_brackets - close_brackets
-            
-            # Se estiver no meio de uma string, tentar fechar
-            quote_count = text.count('"')
-            if quote_count % 2 != 0:
-                # String não fechada, encontrar a última abertura de string
-                last_open_quote = text.rfind('"')
-                if last_open_quote > 0:
-                    # Verificar o contexto antes da última aspas
-                    before_quote = text[:last_open_quote]
-                    # Se há um número par de aspas antes, então a última é uma abertura
-                    if before_quote.count('"') % 2 == 0:
-                        # Estamos no meio de uma string, fechar ela
-                        # Encontrar onde a string deveria terminar (antes de : ou , ou })
-                        remaining = text[last_open_quote+1:]
-                        # Se não há mais nada ou só espaços, fechar a string
-                        if not remaining.strip() or remaining.strip().startswith((':', ',', '}', ']')):
-                            # Inserir aspas de fechamento antes do próximo caractere
-                            if remaining.strip():
-                                next_char_pos = len(text) - len(remaining.lstrip())
-                                text = text[:next_char_pos] + '"' + text[next_char_pos:]
-                            else:
-                                text = text + '"'
-            
-            # Remover vírgulas finais antes de fechar estruturas
-            text = text.rstrip()
-            while text.endswith(','):
-                text = text[:-1].rstrip()
-            
-            # Fechar arrays abertos
-            if missing_brackets > 0:
-                text += ']' * missing_brackets
-            
-            # Fechar objetos abertos
-            if missing_braces > 0:
-                text += '}' * missing_braces
-            
-            # Se ainda estiver quebrado, tentar uma abordagem mais agressiva
-            # Remover a última disciplina incompleta se necessário
-            if missing_braces > 0 or missing_brackets > 0:
-                # Tentar encontrar o último objeto de disciplina completo
-                last_complete_disciplina = original_text.rfind('},')
-                if last_complete_disciplina > 0:
-                    # Pegar tudo até o último objeto completo + fechar arrays/objetos
-                    text = original_text[:last_complete_disciplina+1]
-                    # Fechar o array de disciplinas
-                    if text.count('[') > text.count(']'):
-                        text += ']'
-                    # Fechar o objeto principal
-                    if text.count('{') > text.count('}'):
-                        text += '}'
-            
-            return text
-        
-        # Parsear JSON
-        data = None
-        json_parse_attempts = 0
-        max_json_attempts = 3
-        
-        while json_parse_attempts < max_json_attempts:
-            try:
-                data = json.loads(response_text)
-                break  # Sucesso
-            except json.JSONDecodeError as e:
-                json_parse_attempts += 1
-                print(f"⚠️  Erro ao parsear JSON (tentativa {json_parse_attempts}/{max_json_attempts}): {e}")
-                
-                if json_parse_attempts == 1:
-                    # Primeira tentativa: tentar extrair JSON do texto
-                    import re
-                    json_match = re.search(r'\{.*', response_text, re.DOTALL)
-                    if json_match:
-                        response_text = json_match.group()
-                        print("🔍 Tentando extrair JSON do texto...")
-                        continue
-                
-                elif json_parse_attempts == 2:
-                    # Segunda tentativa: tentar reparar JSON incompleto
-                    print("🔧 Tentando reparar JSON incompleto...")
-                    response_text = try_repair_json(response_text)
-                    continue
-                
-                else:
-                    # Última tentativa: mostrar erro detalhado
-                    print(f"❌ Não foi possível parsear JSON após {max_json_attempts} tentativas")
-                    print(f"📄 Resposta recebida (primeiros 1000 chars): {response_text[:1000]}")
-                    print(f"📄 Resposta recebida (últimos 500 chars): {response_text[-500:]}")
-                    
-                    # Tentar extrair pelo menos algumas informações
-                    import re
-                    # Tentar extrair disciplinas mesmo com JSON quebrado
-                    disciplina_matches = re.findall(r'"nome"\s*:\s*"([^"]+)"', response_text)
-                    if disciplina_matches:
-                        print(f"⚠️  Encontradas {len(disciplina_matches)} disciplinas mesmo com JSON quebrado")
-                        print(f"📋 Disciplinas encontradas: {disciplina_matches[:5]}...")
-                    
-                    raise HTTPException(
-                        status_code=500, 
-                        detail=f"Não foi possível extrair JSON válido da resposta do LLM. O JSON pode estar incompleto. Erro: {str(e)}"
-                    )
+            check_ollama_once()
         
-        if data is None:
-            raise HTTPException(status_code=500, detail="Não foi possível parsear JSON após todas as tentativas")
-        
-        print(f"✅ Dados extraídos: {len(data.get('disciplinas', []))} disciplinas")
-        return data
+        # Prefixo fixo primeiro, texto do OCR no final (com retry)
+        response_text = complete_with_retry(build_extraction_prompt(ocr_text, versao))
+    
+    # Parsear resposta JSON
+    data = parse_llm_json(response_text)
+    
+    print(f"✅ Dados extraídos: {len(data.get('disciplinas', []))} disciplinas")
+    return data
+
+
+def extract_boletim_data_with_llamaindex(image_path: str) -> dict:
+    """
+    Extrai dados do boletim usando LlamaIndex + OCR
+    """
+    print(f"📄 Processando imagem: {image_path}")
+    
+    try:
+        # Extrair texto usando OCR
+        linhas = extract_lines_with_ocr(image_path)
+        with MemoryTracker("llm"):
+            data = extract_boletim_data_from_text(ocr_lines_to_text(linhas))
+        return attach_ocr_confidence(data, linhas)
         
     except Exception as e:
         print(f"❌ Erro na extração: {str(e)}")
         raise HTTPException(status_code=500, detail=f"Erro ao processar imagem: {str(e)}")
 
 
+# Estado de cálculo por sessão (/api/calculate incremental)
+CALC_SESSION_TTL = int(os.getenv("CALC_SESSION_TTL", 3600))  # segundos sem uso até expirar
+CALC_SESSION_MAX = int(os.getenv("CALC_SESSION_MAX", 1000))  # sessões mantidas em memória
+
+_calc_sessions = OrderedDict()
+_calc_sessions_lock = threading.Lock()
+
+# Campos de uma disciplina que o cliente pode alterar
+CAMPOS_EDITAVEIS = ("notas", "faltas", "pontos_extras", "media_provisoria", "media_parcial")
+
+
+def create_calc_session(disciplinas: list, media_minima: float = 7.0) -> dict:
+    """
+    Cria o estado de cálculo de um boletim. Guarda as disciplinas sanitizadas
+    e os cálculos já feitos, para que alterações recalculem só o necessário.
+    """
+    sessao = {
+        "id": os.urandom(12).hex(),
+        "disciplinas": [dict(d) for d in disciplinas],
+        "calculos": [calculate_averages(d, media_minima) for d in disciplinas],
+        "media_minima": media_minima,
+        "versao": 1,
+        "acessado_em": time.time(),
+    }
+    with _calc_sessions_lock:
+        _calc_sessions[sessao["id"]] = sessao
+        # Remover sessões mais antigas se passar do limite
+        while len(_calc_sessions) > CALC_SESSION_MAX:
+            _calc_sessions.popitem(last=False)
+    return sessao
+
+
+def get_calc_session(session_id: str) -> dict:
+    """Busca a sessão, removendo as expiradas"""
+    agora = time.time()
+    with _calc_sessions_lock:
+        # Sessões estão em ordem de acesso: as expiradas ficam no início
+        while _calc_sessions:
+            mais_antiga = next(iter(_calc_sessions.values()))
+            if agora - mais_antiga["acessado_em"] <= CALC_SESSION_TTL:
+                break
+            _calc_sessions.popitem(last=False)
+        
+        sessao = _calc_sessions.get(session_id)
+        if sessao is None:
+            raise HTTPException(status_code=404, detail="Sessão de cálculo não encontrada ou expirada. Faça o upload novamente.")
+        sessao["acessado_em"] = agora
+        _calc_sessions.move_to_end(session_id)
+        return sessao
+
+
+def session_etag(sessao: dict) -> str:
+    return f'W/"{sessao["id"]}-{sessao["versao"]}"'
+
+
+def apply_calc_changes(sessao: dict, alteracoes: list, media_minima: Optional[float]) -> list:
+    """
+    Aplica alterações na sessão e recalcula apenas as disciplinas afetadas.
+    Retorna as linhas que mudaram: {"index": i, <campos alterados>}.
+    """
+    disciplinas = sessao["disciplinas"]
+    
+    # Valida e monta todas as linhas novas antes de tocar na sessão: uma
+    # alteração inválida no meio da lista não pode deixar a sessão pela metade
+    novas = {}
+    for alteracao in alteracoes:
+        if not isinstance(alteracao, dict):
+            raise HTTPException(status_code=400, detail="Alteração inválida")
+        index = alteracao.get("index")
+        if not isinstance(index, int) or isinstance(index, bool) or not 0 <= index < len(disciplinas):
+            raise HTTPException(status_code=400, detail=f"Índice de disciplina inválido: {index}")
+        
+        disciplina = dict(novas.get(index, disciplinas[index]))
+        if "nota" in alteracao:
+            # Alteração de uma única nota: {"index": 0, "posicao": 1, "nota": 8.5}
+            posicao = alteracao.get("posicao")
+            if not isinstance(posicao, int) or isinstance(posicao, bool) or not 0 <= posicao < 3:
+                raise HTTPException(status_code=400, detail=f"Posição de nota inválida: {posicao}")
+            notas = list(disciplina["notas"])
+            notas[posicao] = alteracao["nota"]
+            disciplina["notas"] = notas
+        for campo in CAMPOS_EDITAVEIS:
+            if campo in alteracao:
+                disciplina[campo] = alteracao[campo]
+        
+        # Médias informadas no boletim deixam de valer quando as notas mudam
+        if "nota" in alteracao or "notas" in alteracao or "pontos_extras" in alteracao:
+            for campo in ("media_provisoria", "media_parcial"):
+                if campo not in alteracao:
+                    disciplina.pop(campo, None)
+        
+        novas[index] = validate_and_sanitize_data({"disciplinas": [disciplina]})["disciplinas"][0]
+    
+    for index, disciplina in novas.items():
+        disciplinas[index] = disciplina
+    editadas = set(novas)
+    
+    afetadas = set(editadas)
+    if media_minima is not None and media_minima != sessao["media_minima"]:
+        # Média mínima afeta todas as disciplinas
+        sessao["media_minima"] = media_minima
+        afetadas = set(range(len(disciplinas)))
+        sessao["versao"] += 1
+    
+    linhas = []
+    for index in sorted(afetadas):
+        anteriores = sessao["calculos"][index]
+        calculos = calculate_averages(disciplinas[index], sessao["media_minima"])
+        sessao["calculos"][index] = calculos
+        
+        linha = {campo: valor for campo, valor in calculos.items()
+                 if campo != "media_minima" and anteriores.get(campo) != valor}
+        if index in editadas:
+            linha.update({campo: disciplinas[index][campo] for campo in ("notas", "faltas", "pontos_extras")})
+        if linha:
+            linhas.append({"index": index, **linha})
+    
+    if editadas:
+        sessao["versao"] += 1
+    return linhas
+
+
+def process_upload_image(image_path: str) -> dict:
+    """
+    Extrai os dados de uma imagem enviada, respeitando o orçamento de memória
+    (espera na fila de admissão se a estimativa não couber no momento)
+    """
+    megapixels = image_megapixels(image_path)
+    if MAX_IMAGE_PIXELS > 0:
+        megapixels = min(megapixels, MAX_IMAGE_PIXELS / 1_000_000)
+    estimativa_mb = MEMORY_ADMISSION.estimate_mb(megapixels)
+    
+    MEMORY_ADMISSION.acquire(estimativa_mb)
+    tracker = MemoryTracker("requisição")
+    try:
+        with tracker:
+            return extract_boletim_data_with_llamaindex(image_path)
+    finally:
+        MEMORY_ADMISSION.release(estimativa_mb, megapixels, tracker.aumento_mb)
+
+
 @app.get("/api/health")
 async def health_check():
     """Health check"""
@@ -733,7 +1855,16 @@ async def health_check():
         "status": "OK",
         "message": "Servidor rodando",
         "llm_provider": LLM_PROVIDER,
-        "ocr_engine": OCR_ENGINE
+        "ocr_engine": OCR_ENGINE,
+        "prompt_version": PROMPT_VERSION,
+        "llm_ttft_ms": round(sum(t["ttft"] for t in LLM_TIMINGS) / len(LLM_TIMINGS) * 1000) if LLM_TIMINGS else None,
+        "memoria": {
+            "rss_mb": round(current_rss_mb(), 1),
+            "orcamento_mb": MEMORY_BUDGET_MB or None,
+            "em_andamento": MEMORY_ADMISSION.em_andamento,
+            "na_fila": MEMORY_ADMISSION.na_fila,
+            "ocr_carregado": _paddleocr_instance is not None,
+        }
     }
 
 
@@ -755,8 +1886,8 @@ async def upload_boletim(boletim: UploadFile = File(..., alias="boletim")):
         
         print(f"📤 Arquivo recebido: {boletim.filename} ({temp_file.stat().st_size} bytes)")
         
-        # Extrair dados com LlamaIndex
-        extracted_data = extract_boletim_data_with_llamaindex(str(temp_file))
+        # Extrair dados com LlamaIndex (em thread, para não bloquear o event loop)
+        extracted_data = await run_in_threadpool(process_upload_image, str(temp_file))
         
         # Validar e sanitizar dados extraídos
         print("🔍 Validando e sanitizando dados extraídos...")
@@ -773,6 +1904,9 @@ async def upload_boletim(boletim: UploadFile = File(..., alias="boletim")):
             }
             disciplinas_processadas.append(disciplina_completa)
         
+        # Guardar estado de cálculo para recálculos incrementais
+        sessao = create_calc_session(extracted_data.get("disciplinas", []), 7.0)
+        
         # Atualizar dados extraídos
         extracted_data["disciplinas"] = disciplinas_processadas
         
@@ -781,8 +1915,9 @@ async def upload_boletim(boletim: UploadFile = File(..., alias="boletim")):
         
         return JSONResponse({
             "success": True,
-            "dados": extracted_data
-        })
+            "dados": extracted_data,
+            "sessionId": sessao["id"]
+        }, headers={"ETag": session_etag(sessao)})
         
     except HTTPException:
         raise
@@ -795,10 +1930,42 @@ async def upload_boletim(boletim: UploadFile = File(..., alias="boletim")):
 
 
 @app.post("/api/calculate")
-async def calculate_medias(data: dict):
+async def calculate_medias(data: dict, request: Request):
     """
-    Recalcula médias com média mínima customizada
+    Recalcula médias com média mínima customizada.
+    
+    Com "sessionId" (retornado pelo upload), o cliente envia apenas o que
+    mudou ("mediaMinima" e/ou "alteracoes") e recebe só as linhas alteradas.
+    Sem "sessionId", recalcula a lista completa de "disciplinas".
     """
+    session_id = data.get("sessionId")
+    if session_id:
+        sessao = get_calc_session(session_id)
+        
+        media_minima = data.get("mediaMinima")
+        if media_minima is not None and (
+            isinstance(media_minima, bool) or not isinstance(media_minima, (int, float)) or not 0 <= media_minima <= 10
+        ):
+            raise HTTPException(status_code=400, detail="mediaMinima inválida (número entre 0 e 10)")
+        alteracoes = data.get("alteracoes", [])
+        if not isinstance(alteracoes, list):
+            raise HTTPException(status_code=400, detail="alteracoes deve ser uma lista")
+        
+        with _calc_sessions_lock:
+            # Cliente desatualizado (If-Match diferente da versão atual)
+            if_match = request.headers.get("if-match")
+            if if_match and if_match != session_etag(sessao):
+                raise HTTPException(status_code=412, detail="Estado de cálculo desatualizado. Busque o estado completo em GET /api/calculate/{sessionId}.")
+            linhas = apply_calc_changes(sessao, alteracoes, media_minima)
+            etag = session_etag(sessao)
+        
+        return JSONResponse({
+            "success": True,
+            "sessionId": session_id,
+            "mediaMinima": sessao["media_minima"],
+            "alteracoes": linhas
+        }, headers={"ETag": etag})
+    
     disciplinas = data.get("disciplinas", [])
     media_minima = data.get("mediaMinima", 7.0)
     
@@ -820,10 +1987,402 @@ async def calculate_medias(data: dict):
     })
 
 
-if __name__ == "__main__":
-    import uvicorn
-    port = int(os.getenv("PORT", 5001))
-    print(f"\n🚀 Iniciando servidor na porta {port}...")
-    print(f"📡 API disponível em http://localhost:{port}\n")
-    uvicorn.run(app, host="0.0.0.0", port=port)
+@app.get("/api/calculate/{session_id}")
+async def get_calculate_state(session_id: str, request: Request):
+    """
+    Estado completo de uma sessão de cálculo (para ressincronizar o cliente)
+    """
+    sessao = get_calc_session(session_id)
+    with _calc_sessions_lock:
+        etag = session_etag(sessao)
+        if request.headers.get("if-none-match") == etag:
+            return Response(status_code=304, headers={"ETag": etag})
+        disciplinas = [
+            {**disciplina, **calculos}
+            for disciplina, calculos in zip(sessao["disciplinas"], sessao["calculos"])
+        ]
+        media_minima = sessao["media_minima"]
+    
+    return JSONResponse({
+        "success": True,
+        "sessionId": session_id,
+        "mediaMinima": media_minima,
+        "disciplinas": disciplinas
+    }, headers={"ETag": etag})
+
+
+# Processamento em lote (linha de comando): OCR -> LLM -> validação/cálculo
+# Cada etapa roda em processos próprios, ligados por filas
+BATCH_IMAGE_EXTENSIONS = {".png", ".jpg", ".jpeg", ".webp", ".bmp", ".tif", ".tiff"}
+# Workers que morrem (segfault do PaddleOCR, OOM-kill) são recriados até este limite; depois o lote é abortado
+BATCH_MAX_RESTARTS = int(os.getenv("BATCH_MAX_RESTARTS", "5"))
+# Sem nenhuma etapa concluir um item por este tempo (segundos), o lote é abortado
+BATCH_STALL_TIMEOUT = int(os.getenv("BATCH_STALL_TIMEOUT", "900"))
+
+
+def _batch_stage_ocr(item: dict) -> dict:
+    item["ocr_linhas"] = extract_lines_with_ocr(item["caminho"])
+    return item
+
+
+def _batch_stage_llm(item: dict) -> dict:
+    linhas = item.pop("ocr_linhas")
+    item["dados"] = attach_ocr_confidence(extract_boletim_data_from_text(ocr_lines_to_text(linhas)), linhas)
+    return item
+
+
+def _batch_stage_calculo(item: dict) -> dict:
+    dados = validate_and_sanitize_data(item["dados"])
+    dados["disciplinas"] = [
+        {**disciplina, **calculate_averages(disciplina, item["media_minima"])}
+        for disciplina in dados.get("disciplinas", [])
+    ]
+    item["dados"] = dados
+    return item
+
+
+BATCH_STAGES = [
+    ("ocr", _batch_stage_ocr),
+    ("llm", _batch_stage_llm),
+    ("calculo", _batch_stage_calculo),
+]
+
+
+def _batch_worker(nome_etapa, funcao, entrada, saida):
+    """
+    Worker de uma etapa: recebe um item por vez pelo seu próprio pipe e
+    devolve o resultado (ou o item com "erro") ao processo principal.
+    Sem filas compartilhadas, um worker que morre não deixa lock preso.
+    """
+    while True:
+        try:
+            item = entrada.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+        inicio = time.time()
+        try:
+            item = funcao(item)
+        except Exception as e:
+            detalhe = e.detail if isinstance(e, HTTPException) else str(e)
+            item.pop("ocr_linhas", None)
+            item["erro"] = f"{nome_etapa}: {detalhe}"
+        item["tempos"][nome_etapa] = (inicio, time.time())
+        saida.send(item)
+
+
+def _load_batch_checkpoint(output_path: Path) -> set:
+    """Arquivos já processados com sucesso em execuções anteriores (o próprio JSONL é o checkpoint)"""
+    concluidos = set()
+    if not output_path.exists():
+        return concluidos
+    with open(output_path, encoding="utf-8") as f:
+        for linha in f:
+            try:
+                registro = json.loads(linha)
+            except json.JSONDecodeError:
+                continue  # Linha incompleta (execução interrompida)
+            if "erro" not in registro:
+                concluidos.add(registro.get("arquivo"))
+    return concluidos
+
+
+def run_batch(input_dir: str, output_path: str, workers: dict, media_minima: float = 7.0) -> dict:
+    """
+    Processa todas as imagens de um diretório em pipeline multiprocesso,
+    gravando um registro JSONL por imagem. Imagens já presentes no JSONL
+    (sem erro) são puladas, permitindo retomar uma execução interrompida.
+    """
+    input_dir = Path(input_dir)
+    output_path = Path(output_path)
+    
+    imagens = sorted(p for p in input_dir.rglob("*") if p.is_file() and p.suffix.lower() in BATCH_IMAGE_EXTENSIONS)
+    concluidos = _load_batch_checkpoint(output_path)
+    pendentes = [p for p in imagens if str(p.relative_to(input_dir)) not in concluidos]
+    print(f"📂 {len(imagens)} imagens encontradas, {len(imagens) - len(pendentes)} já processadas, {len(pendentes)} pendentes")
+    
+    if not pendentes:
+        return {}
+    
+    # Cada worker tem seus próprios pipes e recebe um item por vez: o processo
+    # principal distribui os itens, então sabe qual item cada worker está
+    # processando e nenhum lock compartilhado fica preso se um worker morrer
+    def iniciar_worker(i):
+        nome, funcao = BATCH_STAGES[i]
+        entrada_filho, entrada = mp.Pipe(duplex=False)
+        saida, saida_filho = mp.Pipe(duplex=False)
+        processo = mp.Process(target=_batch_worker, args=(nome, funcao, entrada_filho, saida_filho), daemon=True)
+        processo.start()
+        entrada_filho.close()
+        saida_filho.close()
+        return {"etapa": i, "processo": processo, "entrada": entrada, "saida": saida, "item": None}
+    
+    todos = [iniciar_worker(i) for i, (nome, _) in enumerate(BATCH_STAGES) for _ in range(workers[nome])]
+    # Itens aguardando cada etapa; limitados para que uma etapa rápida não acumule itens em memória
+    esperando = [deque() for _ in BATCH_STAGES]
+    limites = [max(2, 2 * workers[nome]) for nome, _ in BATCH_STAGES]
+    proximo = 0
+    
+    inicio = time.time()
+    ultimo_progresso = inicio
+    sucesso = erros = reinicios = 0
+    abortado = None
+    gravados = set()
+    tempos_etapa = {nome: [] for nome, _ in BATCH_STAGES}
+    
+    precisa_quebra = output_path.exists() and output_path.stat().st_size > 0
+    if precisa_quebra:
+        with open(output_path, "rb") as f:
+            f.seek(-1, os.SEEK_END)
+            precisa_quebra = f.read(1) != b"\n"
+    
+    with open(output_path, "a", encoding="utf-8") as saida_jsonl:
+        if precisa_quebra:
+            saida_jsonl.write("\n")
+        
+        def gravar(item):
+            nonlocal sucesso, erros
+            gravados.add(item["indice"])
+            n = len(gravados)
+            for nome, intervalo in item["tempos"].items():
+                tempos_etapa[nome].append(intervalo)
+            
+            registro = {"arquivo": item["arquivo"]}
+            if "erro" in item:
+                registro["erro"] = item["erro"]
+                erros += 1
+                print(f"❌ [{n}/{len(pendentes)}] {item['arquivo']}: {item['erro']}")
+            else:
+                registro["dados"] = item["dados"]
+                sucesso += 1
+                print(f"✅ [{n}/{len(pendentes)}] {item['arquivo']}: {len(item['dados'].get('disciplinas', []))} disciplinas")
+            registro["tempos"] = {nome: round(fim - ini, 3) for nome, (ini, fim) in item["tempos"].items()}
+            
+            saida_jsonl.write(json.dumps(registro, ensure_ascii=False) + "\n")
+            saida_jsonl.flush()
+        
+        def concluir(worker, item):
+            nonlocal ultimo_progresso
+            worker["item"] = None
+            ultimo_progresso = time.time()
+            i = worker["etapa"]
+            if "erro" in item or i + 1 == len(BATCH_STAGES):
+                gravar(item)
+            else:
+                esperando[i + 1].append(item)
+        
+        while len(gravados) < len(pendentes) and not abortado:
+            # Distribuir itens aos workers livres (de trás para frente, para esvaziar o pipeline)
+            for worker in sorted(todos, key=lambda w: -w["etapa"]):
+                i = worker["etapa"]
+                if worker["item"] is not None or not worker["processo"].is_alive():
+                    continue
+                if i == 0 and not esperando[0] and proximo < len(pendentes):
+                    caminho = pendentes[proximo]
+                    esperando[0].append({
+                        "indice": proximo,
+                        "arquivo": str(caminho.relative_to(input_dir)),
+                        "caminho": str(caminho),
+                        "media_minima": media_minima,
+                        "tempos": {},
+                    })
+                    proximo += 1
+                if not esperando[i] or (i + 1 < len(BATCH_STAGES) and len(esperando[i + 1]) >= limites[i + 1]):
+                    continue
+                item = esperando[i].popleft()
+                try:
+                    worker["entrada"].send(item)
+                    worker["item"] = item
+                except OSError:
+                    esperando[i].appendleft(item)  # Worker morreu; tratado abaixo
+            
+            ocupados = [worker["saida"] for worker in todos if worker["item"] is not None]
+            if ocupados:
+                prontos = wait_connections(ocupados, timeout=1.0)
+            else:
+                prontos = []
+                time.sleep(0.1)
+            for worker in todos:
+                if worker["saida"] in prontos:
+                    try:
+                        concluir(worker, worker["saida"].recv())
+                    except EOFError:
+                        pass  # Worker morreu; tratado abaixo
+            
+            # Worker morto (segfault do PaddleOCR, OOM-kill): grava o item que ele processava e recria o worker
+            for indice, worker in enumerate(todos):
+                processo = worker["processo"]
+                if processo.is_alive():
+                    continue
+                nome = BATCH_STAGES[worker["etapa"]][0]
+                try:
+                    # Resultado enviado logo antes de morrer ainda está no pipe
+                    if worker["item"] is not None and worker["saida"].poll():
+                        concluir(worker, worker["saida"].recv())
+                except (EOFError, OSError):
+                    pass
+                if worker["item"] is not None:
+                    item = worker["item"]
+                    item.pop("ocr_linhas", None)
+                    item["erro"] = f"{nome}: worker terminou inesperadamente (exitcode {processo.exitcode})"
+                    concluir(worker, item)
+                worker["entrada"].close()
+                worker["saida"].close()
+                if reinicios >= BATCH_MAX_RESTARTS:
+                    abortado = f"mais de {BATCH_MAX_RESTARTS} workers reiniciados"
+                    break
+                reinicios += 1
+                print(f"♻️  Worker de {nome} terminou (exitcode {processo.exitcode}), reiniciando ({reinicios}/{BATCH_MAX_RESTARTS})")
+                todos[indice] = iniciar_worker(worker["etapa"])
+            
+            # Watchdog: nenhuma etapa concluiu um item por BATCH_STALL_TIMEOUT segundos
+            if not abortado and BATCH_STALL_TIMEOUT > 0 and time.time() - ultimo_progresso > BATCH_STALL_TIMEOUT:
+                abortado = f"nenhum progresso em {BATCH_STALL_TIMEOUT}s"
+    
+    if abortado:
+        # Itens não gravados continuam pendentes para a próxima execução
+        print(f"🛑 Lote abortado: {abortado} ({len(pendentes) - len(gravados)} imagens não processadas)")
+        for worker in todos:
+            worker["processo"].terminate()
+    else:
+        for worker in todos:
+            try:
+                worker["entrada"].send(None)
+            except OSError:
+                pass
+        for worker in todos:
+            worker["processo"].join(timeout=30)
+            if worker["processo"].is_alive():
+                worker["processo"].terminate()
+    
+    total = time.time() - inicio
+    
+    # Vazão por etapa: itens / intervalo em que a etapa esteve ativa
+    resumo = {
+        "imagens": len(pendentes),
+        "sucesso": sucesso,
+        "erros": erros,
+        "reinicios": reinicios,
+        "abortado": bool(abortado),
+        "segundos": round(total, 1),
+        "etapas": {},
+    }
+    print(f"\n📊 Resumo: {sucesso} ok, {erros} com erro em {total:.1f}s ({len(gravados) / total * 60:.1f} imagens/min)")
+    for nome, _ in BATCH_STAGES:
+        intervalos = tempos_etapa[nome]
+        if not intervalos:
+            continue
+        janela = max(fim for _, fim in intervalos) - min(ini for ini, _ in intervalos)
+        por_minuto = len(intervalos) / janela * 60 if janela > 0 else 0
+        media = sum(fim - ini for ini, fim in intervalos) / len(intervalos)
+        resumo["etapas"][nome] = {
+            "workers": workers[nome],
+            "imagens": len(intervalos),
+            "imagens_por_minuto": round(por_minuto, 1),
+            "segundos_por_imagem": round(media, 2),
+        }
+        print(f"   {nome:<8} {workers[nome]} workers | {len(intervalos)} imagens | {por_minuto:.1f} imagens/min | {media:.2f}s por imagem")
+    return resumo
+
+
+def _sample_ocr_text() -> str:
+    """Texto OCR sintético (cabeçalho + uma linha por disciplina conhecida) para benchmarks"""
+    linhas = ["ESCOLA ESTADUAL", "BOLETIM ESCOLAR 2024", "Aluno: ALUNO TESTE", "Matrícula: 123456", "Turma: 9A", "1º Bimestre",
+              "Disciplina", "Faltas", "1ª AV", "2ª AV", "3ª AV", "Média Provisória", "Média Parcial"]
+    for i, (nome, _) in enumerate(DISCIPLINAS_CONHECIDAS):
+        linhas += [nome, str(i % 4), f"{6 + i % 4}.5", f"{7 + i % 3}.0", "-", f"{6.75 + i % 3:.2f}", f"{6.75 + i % 3:.2f}"]
+    return "\n".join(linhas)
 
+
+def benchmark_prompts(ocr_text: str, runs: int = 3) -> dict:
+    """
+    Mede o TTFT de cada versão de prompt no provedor configurado, pelo mesmo
+    caminho usado em produção (v1 na OpenAI via VectorStoreIndex): o prompt
+    completo e, se o texto tiver tabela, os prompts do modo em seções
+    (cabeçalho e primeiro trecho). A primeira chamada de cada prompt é fria
+    (sem prefixo em cache); as demais mostram o ganho do cache de prefixo.
+    """
+    cabecalho, colunas, secoes, _ = split_ocr_sections(ocr_text)
+    
+    def medir(prompt, executar=stream_complete_timed):
+        ttfts, totais = [], []
+        for _ in range(runs):
+            executar(prompt)
+            ttfts.append(LLM_TIMINGS[-1]["ttft"])
+            totais.append(LLM_TIMINGS[-1]["total"])
+        quentes = sorted(ttfts[1:] or ttfts)
+        return {
+            "prompt_chars": len(prompt),
+            "ttft_frio_ms": round(ttfts[0] * 1000),
+            "ttft_ms": round(quentes[len(quentes) // 2] * 1000),
+            "total_s": round(sorted(totais)[len(totais) // 2], 2),
+        }
+    
+    resultados = {}
+    for versao in EXTRACTION_PROMPTS:
+        if uses_vector_index(versao):
+            completo = medir(EXTRACTION_PROMPTS[versao], lambda prompt: query_index_timed(ocr_text, prompt))
+        else:
+            completo = medir(build_extraction_prompt(ocr_text, versao))
+        resultados[versao] = {"completo": completo}
+        if secoes:
+            resultados[versao]["cabecalho"] = medir(build_header_prompt(cabecalho, versao))
+            resultados[versao]["secao"] = medir(build_section_prompt(colunas, secoes[0], versao))
+    
+    print(f"\n📊 TTFT por versão de prompt ({LLM_PROVIDER}, {runs} execuções):")
+    for versao, prompts in resultados.items():
+        for tipo, r in prompts.items():
+            print(f"   {versao} {tipo:<9} {r['prompt_chars']:>5} chars | TTFT frio {r['ttft_frio_ms']:>6} ms | TTFT (mediana) {r['ttft_ms']:>6} ms | total {r['total_s']}s")
+    if "v1" in resultados and "v2" in resultados:
+        for tipo, r in resultados["v2"].items():
+            base = resultados["v1"].get(tipo)
+            if base and base["ttft_ms"]:
+                ganho = 1 - r["ttft_ms"] / base["ttft_ms"]
+                print(f"   v2 vs v1 ({tipo}): TTFT {-ganho:+.0%}")
+    return resultados
+
+
+if __name__ == "__main__":
+    import argparse
+    
+    def inteiro_positivo(valor: str) -> int:
+        """Quantidade de workers: com 0 a etapa nunca consome a fila e o lote trava"""
+        numero = int(valor)
+        if numero < 1:
+            raise argparse.ArgumentTypeError(f"deve ser >= 1 (recebido {valor})")
+        return numero
+    
+    parser = argparse.ArgumentParser(description="Sistema de Análise de Boletim Escolar")
+    subparsers = parser.add_subparsers(dest="comando")
+    
+    batch_parser = subparsers.add_parser("batch", help="Processa um diretório de boletins e grava os resultados em JSONL")
+    batch_parser.add_argument("diretorio", help="Diretório com as imagens (busca recursiva)")
+    batch_parser.add_argument("-o", "--output", default="resultados.jsonl", help="Arquivo JSONL de saída (também usado como checkpoint)")
+    batch_parser.add_argument("--ocr-workers", type=inteiro_positivo, default=max(1, (os.cpu_count() or 2) // 2), help="Processos da etapa de OCR")
+    batch_parser.add_argument("--llm-workers", type=inteiro_positivo, default=4, help="Processos da etapa de LLM")
+    batch_parser.add_argument("--calc-workers", type=inteiro_positivo, default=1, help="Processos da etapa de validação/cálculo")
+    batch_parser.add_argument("--media-minima", type=float, default=7.0, help="Média mínima para aprovação")
+    
+    bench_parser = subparsers.add_parser("bench-prompt", help="Compara o TTFT das versões de prompt no provedor configurado")
+    bench_parser.add_argument("--ocr-text", help="Arquivo com texto OCR (padrão: boletim sintético)")
+    bench_parser.add_argument("--runs", type=int, default=3, help="Execuções por versão (a primeira é fria)")
+    
+    args = parser.parse_args()
+    
+    if args.comando == "bench-prompt":
+        texto = Path(args.ocr_text).read_text(encoding="utf-8") if args.ocr_text else _sample_ocr_text()
+        benchmark_prompts(texto, args.runs)
+    elif args.comando == "batch":
+        run_batch(
+            args.diretorio,
+            args.output,
+            {"ocr": args.ocr_workers, "llm": args.llm_workers, "calculo": args.calc_workers},
+            args.media_minima,
+        )
+    else:
+        import uvicorn
+        port = int(os.getenv("PORT", 5001))
+        print(f"\n🚀 Iniciando servidor na porta {port}...")
+        print(f"📡 API disponível em http://localhost:{port}\n")
+        uvicorn.run(app, host="0.0.0.0", port=port)